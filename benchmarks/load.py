@@ -0,0 +1,344 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load benchmark: replay realistic flows against a running localstripe, with
+concurrent clients, and report throughput, latency percentiles and server-side
+metrics.
+
+    python -m benchmarks.load --concurrency 10 --duration 30
+    python -m benchmarks.load --save-baseline baseline.json
+    python -m benchmarks.load --baseline baseline.json  # exits 1 if slower
+
+Data is created with a `Stripe-Account` header, so it is separate from other
+data of the server, and flushed before each run."""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from localstripe.replay import encode_params, percentile
+from .scenarios import SCENARIOS, setup
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class Client(object):
+    def __init__(self, session, url, api_key, account):
+        self.session = session
+        self.url = url
+        self.headers = {'Authorization': 'Bearer ' + api_key,
+                        'Stripe-Account': account}
+        # Latencies in seconds, and failures, by step:
+        self.latencies = {}
+        self.failures = {}
+
+    async def request(self, step, method, path, params=None):
+        params = list(encode_params(params or {}))
+        start = time.perf_counter()
+        async with self.session.request(
+                method, self.url + path, headers=self.headers,
+                params=params if method == 'GET' else None,
+                data=params if method != 'GET' else None) as r:
+            body = await r.read()
+        self.latencies.setdefault(step, []).append(
+            time.perf_counter() - start)
+        if r.status >= 400:
+            self.failures[step] = self.failures.get(step, 0) + 1
+            raise RequestFailed('%s %s: %d %s' % (method, path, r.status,
+                                                  body[:200]))
+        return json.loads(body)
+
+
+def parse_metrics(text):
+    """Return samples of Prometheus text format, by `(name, labels)`."""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        match = re.match(r'^(\w+)(?:\{(.*)\})? (\S+)$', line)
+        if match:
+            labels = frozenset(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"',
+                                          match.group(2) or ''))
+            samples[(match.group(1), labels)] = float(match.group(3))
+    return samples
+
+
+def metric_delta(before, after, name, **labels):
+    """Sum of the increase of `name` samples with `labels`, between two
+    scrapes."""
+    return sum(value - before.get(key, 0) for key, value in after.items()
+               if key[0] == name and set(labels.items()) <= key[1])
+
+
+def histogram_quantile(before, after, name, q):
+    """Upper bound of the bucket containing quantile `q` of values observed
+    between two scrapes, for all label values."""
+    buckets = {}
+    for key, value in after.items():
+        if key[0] == name + '_bucket':
+            le = dict(key[1])['le']
+            buckets[le] = buckets.get(le, 0) + value - before.get(key, 0)
+    bounds = sorted(buckets, key=float)
+    if not bounds or not buckets[bounds[-1]]:
+        return None
+    for bound in bounds:
+        if buckets[bound] >= q * buckets[bounds[-1]]:
+            return float(bound)
+
+
+def server_side_results(before, after):
+    requests = metric_delta(before, after,
+                            'localstripe_http_request_duration_seconds_count')
+    duration = metric_delta(before, after,
+                            'localstripe_http_request_duration_seconds_sum')
+    return {
+        'requests': int(requests),
+        'mean_ms': 1000 * duration / requests if requests else None,
+        'p99_ms_at_most': 1000 * (histogram_quantile(
+            before, after, 'localstripe_http_request_duration_seconds', .99)
+            or 0),
+        'dumps': int(metric_delta(
+            before, after, 'localstripe_store_dump_duration_seconds_count')),
+        'dumps_seconds': metric_delta(
+            before, after, 'localstripe_store_dump_duration_seconds_sum'),
+        'dumps_bytes': int(metric_delta(
+            before, after, 'localstripe_store_dump_bytes_total')),
+        'event_loop_lag_p99_ms_at_most': 1000 * (histogram_quantile(
+            before, after, 'localstripe_event_loop_lag_seconds', .99) or 0),
+        'webhooks_delivered': int(metric_delta(
+            before, after, 'localstripe_webhook_deliveries_total',
+            result='success')),
+        'webhooks_failed': int(metric_delta(
+            before, after, 'localstripe_webhook_deliveries_total') -
+            metric_delta(before, after, 'localstripe_webhook_deliveries_total',
+                         result='success')),
+    }
+
+
+async def start_webhook_sink(received):
+    async def receive(request):
+        event = await request.json()
+        received[event['type']] = received.get(event['type'], 0) + 1
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post('/', receive)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, 'http://127.0.0.1:%d/' % runner.addresses[0][1]
+
+
+async def run(args):
+    mix = {name: SCENARIOS[name] for name in args.scenarios}
+    names = list(mix)
+    weights = [weight for _, weight in mix.values()]
+
+    connector = None
+    if args.unix_socket:
+        connector = aiohttp.UnixConnector(path=args.unix_socket)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        client = Client(session, args.url, args.api_key, args.account)
+
+        async def config(method, path, **kwargs):
+            async with session.request(method, args.url + path,
+                                       headers=client.headers,
+                                       **kwargs) as r:
+                r.raise_for_status()
+                return await r.text()
+
+        await config('DELETE', '/_config/data')
+        received = {}
+        if args.webhooks:
+            sink, sink_url = await start_webhook_sink(received)
+            await config('POST', '/_config/webhooks/benchmark',
+                         data={'url': sink_url, 'secret': 'whsec_benchmark'})
+
+        context = await setup(client)
+        before = parse_metrics(await config('GET', '/_config/metrics'))
+
+        flows = {name: 0 for name in names}
+        failed_flows = {name: 0 for name in names}
+        errors = []
+        start = time.perf_counter()
+        deadline = start + args.duration
+
+        async def user(i):
+            rng = random.Random('%s-%d' % (args.seed, i))
+            iterations = 0
+            while (time.perf_counter() < deadline if args.iterations is None
+                   else iterations < args.iterations):
+                iterations += 1
+                name = rng.choices(names, weights)[0]
+                try:
+                    await mix[name][0](client, context, rng)
+                    flows[name] += 1
+                except RequestFailed as e:
+                    failed_flows[name] += 1
+                    errors.append(str(e))
+
+        await asyncio.gather(*(user(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+        if args.webhooks:
+            # localstripe sends webhooks after a delay:
+            await asyncio.sleep(args.webhook_wait)
+            await sink.cleanup()
+        after = parse_metrics(await config('GET', '/_config/metrics'))
+
+    del client.latencies['setup']
+    requests = sum(len(values) for values in client.latencies.values())
+    steps = {}
+    for step, values in sorted(client.latencies.items()):
+        values.sort()
+        steps[step] = {'count': len(values),
+                       'failures': client.failures.get(step, 0),
+                       'p50_ms': 1000 * percentile(values, 50),
+                       'p90_ms': 1000 * percentile(values, 90),
+                       'p99_ms': 1000 * percentile(values, 99),
+                       'max_ms': 1000 * values[-1]}
+    return {
+        'config': {'concurrency': args.concurrency,
+                   'duration': args.duration, 'iterations': args.iterations,
+                   'scenarios': names, 'seed': args.seed},
+        'elapsed': elapsed,
+        'flows': flows,
+        'failed_flows': failed_flows,
+        'errors': errors[:10],
+        'requests': requests,
+        'requests_per_second': requests / elapsed,
+        'flows_per_second': sum(flows.values()) / elapsed,
+        'steps': steps,
+        'webhooks_received': received,
+        'server': server_side_results(before, after),
+    }
+
+
+def print_results(results):
+    print('%d flows (%.1f/s), %d failed, %d requests (%.1f/s) in %.1f s'
+          % (sum(results['flows'].values()), results['flows_per_second'],
+             sum(results['failed_flows'].values()), results['requests'],
+             results['requests_per_second'], results['elapsed']))
+    for error in results['errors']:
+        print('  error: ' + error)
+    print()
+    print('%-24s %7s %7s %8s %8s %8s %8s' % (
+        'step', 'count', 'failed', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for step, stats in results['steps'].items():
+        print('%-24s %7d %7d %8.2f %8.2f %8.2f %8.2f' % (
+            step, stats['count'], stats['failures'], stats['p50_ms'],
+            stats['p90_ms'], stats['p99_ms'], stats['max_ms']))
+    print()
+    print('webhooks received: %d' % sum(results['webhooks_received'].values()))
+    print('server side:')
+    for key, value in results['server'].items():
+        print('  %s: %s' % (key, round(value, 3) if value is not None
+                            else '-'))
+
+
+def compare(results, baseline, tolerance):
+    """Print the comparison with a baseline, and return whether performance
+    regressed by more than `tolerance` (e.g. 0.2 for 20%)."""
+    regressed = False
+
+    def check(what, old, new, lower_is_better):
+        nonlocal regressed
+        if not old or new is None:
+            return
+        change = (new - old) / old
+        worse = change > tolerance if lower_is_better else -change > tolerance
+        # Ignore differences of latency below 1 ms, which are noise:
+        if lower_is_better and abs(new - old) < 1:
+            worse = False
+        regressed = regressed or worse
+        print('%-40s %10.2f -> %10.2f (%+.0f%%)%s'
+              % (what, old, new, 100 * change,
+                 '  REGRESSION' if worse else ''))
+
+    print('comparison with baseline:')
+    check('requests per second', baseline['requests_per_second'],
+          results['requests_per_second'], False)
+    for step, old in baseline['steps'].items():
+        new = results['steps'].get(step)
+        if new is not None:
+            for p in ('p50_ms', 'p99_ms'):
+                check('%s %s' % (step, p), old[p], new[p], True)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay realistic flows against a running localstripe, '
+                    'and measure its performance.')
+    parser.add_argument('--url', default='http://localhost:8420')
+    parser.add_argument('--unix-socket', metavar='PATH',
+                        help='connect to this unix socket')
+    parser.add_argument('--api-key', default='sk_test_benchmark')
+    parser.add_argument('--account', default='acct_benchmark',
+                        help='Stripe-Account header, to work on separate '
+                             'data (flushed before the run)')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='duration of the run, in seconds')
+    parser.add_argument('--iterations', type=int,
+                        help='run this number of flows per client, instead '
+                             'of for some duration')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS),
+                        choices=list(SCENARIOS))
+    parser.add_argument('--seed', default='localstripe')
+    parser.add_argument('--no-webhooks', dest='webhooks',
+                        action='store_false',
+                        help="don't register a webhook to a local receiver")
+    parser.add_argument('--webhook-wait', type=float, default=2,
+                        help='time to wait for webhooks after the run')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write results to this file')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='save results as a baseline')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with this baseline, and exit with '
+                             'code 1 in case of regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='accepted regression compared to the baseline '
+                             '(default: 0.2, i.e. 20%%)')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
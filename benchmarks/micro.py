@@ -0,0 +1,350 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks of localstripe internals, on synthetic data generated in
+this process, so that each optimisation can be measured by itself.
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --benchmarks list_all --sizes 1000 1000000
+    python -m benchmarks.micro --save-baseline micro.json
+    python -m benchmarks.micro --baseline micro.json  # exits 1 if slower
+
+Benchmarks marked as sized run once for each store size, with that number of
+customers in the store."""
+
+import argparse
+from contextlib import contextmanager
+import copy
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+from multidict import MultiDict
+
+from localstripe.embedded import Client
+from localstripe.resources import Customer, Event, Invoice, List, \
+    SubscriptionItem, stores
+from localstripe.server import unflatten_data
+from localstripe.tenants import current_tenant
+from localstripe.webhooks import _encode_payload, _signature_header, \
+    hold_webhooks
+from .scenarios import CARD
+
+
+def create_data(client):
+    """Create a few objects of each kind through the API, and return them."""
+    product = client.request('POST', '/v1/products',
+                             {'name': 'Benchmark', 'type': 'service'})
+    plan = client.request('POST', '/v1/plans', {
+        'product': product['id'], 'amount': 1500, 'currency': 'eur',
+        'interval': 'month'})
+    tiers = [{'up_to': up_to, 'unit_amount': 100 - up_to, 'flat_amount': 50}
+             for up_to in range(10, 100, 10)]
+    tiers.append({'up_to': 'inf', 'unit_amount': 5})
+    tiered_plans = {
+        mode: client.request('POST', '/v1/plans', {
+            'product': product['id'], 'currency': 'eur',
+            'interval': 'month', 'billing_scheme': 'tiered',
+            'tiers_mode': mode, 'tiers': tiers})
+        for mode in ('volume', 'graduated')}
+
+    customer = client.request('POST', '/v1/customers', {
+        'email': 'benchmark@example.com', 'description': 'Benchmark',
+        'metadata': {'key%d' % i: 'value%d' % i for i in range(5)}})
+    pm = client.request('POST', '/v1/payment_methods',
+                        {'type': 'card', 'card': CARD})
+    client.request('POST', '/v1/payment_methods/%s/attach' % pm['id'],
+                   {'customer': customer['id']})
+    client.request('POST', '/v1/customers/%s' % customer['id'],
+                   {'invoice_settings': {'default_payment_method': pm['id']}})
+    sub = client.request('POST', '/v1/subscriptions', {
+        'customer': customer['id'], 'items': [{'plan': plan['id']}]})
+
+    with hold_webhooks() as events:
+        customer = Customer._api_retrieve(customer['id'])
+        data = {
+            'customer': customer,
+            'invoice': Invoice._api_retrieve(sub['latest_invoice']),
+            'event': Event('customer.updated', customer),
+            # In the last tier, where computing amounts is the longest:
+            'items': {mode: SubscriptionItem(plan=plan['id'], quantity=95)
+                      for mode, plan in tiered_plans.items()},
+        }
+        events.clear()
+    return data
+
+
+def populate(store, template, size):
+    """Add copies of the `template` customer to the store, up to `size`
+    customers."""
+    count = len(store.of_type('customer'))
+    new = {}
+    for i in range(count, size):
+        customer = copy.copy(template)
+        id = 'cus_benchmark%08d' % i
+        # Each customer has its own containers, otherwise pickle would only
+        # store them once, and dumps would be much smaller than with real
+        # customers. (Bypass `__setattr__()`, which invalidates caches on
+        # each change.)
+        vars(customer).update(
+            id=id, email='user%d@example.com' % i,
+            metadata={'index': str(i)},
+            invoice_settings=copy.deepcopy(template.invoice_settings),
+            sources=List('/v1/customers/%s/sources' % id),
+            tax_ids=List('/v1/customers/%s/tax_ids' % id),
+            _pending_invoice_items={})
+        new['customer:' + customer.id] = customer
+    store.update(new)
+
+
+@contextmanager
+def bench_unflatten_data(data, store):
+    # Like the form of a subscription creation, with items and metadata:
+    form = MultiDict()
+    for i in range(5):
+        form.add('items[%d][plan]' % i, 'plan_benchmark%d' % i)
+        form.add('items[%d][quantity]' % i, str(i + 1))
+        form.add('items[%d][tax_rates][]' % i, 'txr_benchmark')
+        form.add('items[%d][metadata][index]' % i, str(i))
+    for i in range(10):
+        form.add('metadata[key%d]' % i, 'value%d' % i)
+    for path in ('latest_invoice', 'customer', 'pending_setup_intent'):
+        form.add('expand[]', path)
+    form.add('payment_settings[payment_method_options][card]'
+             '[request_three_d_secure]', 'any')
+    yield lambda: unflatten_data(form)
+
+
+@contextmanager
+def bench_export(data, store):
+    yield data['customer']._export
+
+
+@contextmanager
+def bench_export_expand(data, store):
+    expand = ['customer', 'subscription', 'charge', 'payment_intent']
+    yield lambda: data['invoice']._export(expand=expand)
+
+
+@contextmanager
+def bench_list_all(data, store):
+    yield lambda: Customer._api_list_all('/v1/customers')._export()
+
+
+@contextmanager
+def bench_list_all_starting_after(data, store):
+    customers = store.of_type('customer')
+    starting_after = customers[len(customers) // 2].id
+    yield lambda: Customer._api_list_all(
+        '/v1/customers', starting_after=starting_after)._export()
+
+
+@contextmanager
+def bench_dump_to_disk(data, store):
+    store.path = data['path']
+    try:
+        yield store.dump_to_disk
+    finally:
+        store.path = None
+
+
+@contextmanager
+def bench_try_load_from_disk(data, store):
+    store.path = data['path']
+    try:
+        store.dump_to_disk()
+        yield store.try_load_from_disk
+    finally:
+        store.path = None
+
+
+@contextmanager
+def bench_calculate_amount_volume(data, store):
+    yield data['items']['volume']._calculate_amount
+
+
+@contextmanager
+def bench_calculate_amount_graduated(data, store):
+    yield data['items']['graduated']._calculate_amount
+
+
+@contextmanager
+def bench_calculate_amounts_graduated(data, store):
+    # 1000 quantities of all tiers, in random order:
+    quantities = [random.randint(1, 150) for _ in range(1000)]
+    plan = data['items']['graduated'].plan
+    yield lambda: plan._calculate_amounts(quantities)
+
+
+@contextmanager
+def bench_webhook_payload(data, store):
+    yield lambda: _encode_payload(data['event'])
+
+
+@contextmanager
+def bench_webhook_sign(data, store):
+    payload = _encode_payload(data['event'])
+    yield lambda: _signature_header('whsec_benchmark', data['event'].created,
+                                    payload)
+
+
+# Benchmarks, and whether they run for each store size:
+BENCHMARKS = {
+    'unflatten_data': (bench_unflatten_data, False),
+    'export': (bench_export, False),
+    'export.expand': (bench_export_expand, False),
+    'list_all': (bench_list_all, True),
+    'list_all.starting_after': (bench_list_all_starting_after, True),
+    'dump_to_disk': (bench_dump_to_disk, True),
+    'try_load_from_disk': (bench_try_load_from_disk, True),
+    'calculate_amount.volume': (bench_calculate_amount_volume, False),
+    'calculate_amount.graduated': (bench_calculate_amount_graduated, False),
+    'calculate_amounts.graduated': (bench_calculate_amounts_graduated, False),
+    'webhook.payload': (bench_webhook_payload, False),
+    'webhook.sign': (bench_webhook_sign, False),
+}
+
+
+def measure(func, min_time, repeat):
+    """Return the number of calls per measure (so that a measure lasts at
+    least `min_time` seconds), and the best time of one call among `repeat`
+    measures, in seconds. Like `timeit`, the garbage collector is disabled
+    while measuring."""
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+    times = [elapsed] + timer.repeat(repeat - 1, number)
+    return number, min(times) / number
+
+
+def run(args):
+    random.seed(args.seed)  # so that IDs are the same on each run
+    client = Client()
+    fd, path = tempfile.mkstemp(prefix='localstripe-benchmark-',
+                                suffix='.pickle')
+    os.close(fd)
+    token = current_tenant.set(client.tenant)
+    try:
+        data = create_data(client)
+        data['path'] = path
+        store = stores[client.tenant]
+
+        results = {}
+        for size in sorted(args.sizes):
+            populate(store, data['customer'], size)
+            for name in args.benchmarks:
+                func, sized = BENCHMARKS[name]
+                if not sized and size != min(args.sizes):
+                    continue
+                key = '%s[%d]' % (name, size) if sized else name
+                with func(data, store) as timed:
+                    number, best = measure(timed, args.min_time, args.repeat)
+                results[key] = {'size': size if sized else None,
+                                'loops': number, 'seconds': best}
+                print_result(key, results[key])
+    finally:
+        current_tenant.reset(token)
+        client.close()
+        os.unlink(path)
+
+    return {
+        'config': {'benchmarks': args.benchmarks, 'sizes': args.sizes,
+                   'repeat': args.repeat, 'min_time': args.min_time,
+                   'seed': args.seed},
+        'results': results,
+    }
+
+
+def format_duration(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.2f %s' % (seconds / scale, unit)
+    return '%.0f ns' % (seconds / 1e-9)
+
+
+def print_result(key, result):
+    print('%-40s %10s per call %12d loops'
+          % (key, format_duration(result['seconds']), result['loops']))
+
+
+def compare(results, baseline, tolerance):
+    """Print the comparison with a baseline, and return whether performance
+    regressed by more than `tolerance` (e.g. 0.2 for 20%)."""
+    regressed = False
+    print('comparison with baseline:')
+    for key, old in baseline['results'].items():
+        new = results['results'].get(key)
+        if new is None:
+            continue
+        change = (new['seconds'] - old['seconds']) / old['seconds']
+        worse = change > tolerance
+        regressed = regressed or worse
+        print('%-40s %10s -> %10s (%+.0f%%)%s'
+              % (key, format_duration(old['seconds']),
+                 format_duration(new['seconds']), 100 * change,
+                 '  REGRESSION' if worse else ''))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the performance of localstripe internals.')
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS))
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[1000, 10000, 100000],
+                        help='numbers of customers in the store, for sized '
+                             'benchmarks (default: 1000 10000 100000)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of measures, the best one is kept')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration of a measure, in seconds')
+    parser.add_argument('--seed', default='localstripe')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write results to this file')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='save results as a baseline')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with this baseline, and exit with '
+                             'code 1 in case of regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='accepted regression compared to the baseline '
+                             '(default: 0.2, i.e. 20%%)')
+    args = parser.parse_args()
+    if args.repeat < 1 or args.min_time <= 0 or min(args.sizes) < 1:
+        parser.error('--repeat, --min-time and --sizes must be positive')
+
+    results = run(args)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
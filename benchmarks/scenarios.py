@@ -0,0 +1,119 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Flows replayed by the load benchmark (see `load.py`).
+
+Each scenario is a coroutine `scenario(client, context, rng)` which sends
+requests with `client.request(step, method, path, params)`, where `step` names
+the request in the report. `context` is what `setup()` returned, and `rng` is
+a `random.Random` instance, so that runs are reproducible."""
+
+CARD = {'number': '4242424242424242', 'exp_month': 12, 'exp_year': 2030,
+        'cvc': '123'}
+
+
+async def setup(client):
+    product = await client.request('setup', 'POST', '/v1/products', {
+        'name': 'Benchmark', 'type': 'service'})
+    plan = await client.request('setup', 'POST', '/v1/plans', {
+        'product': product['id'], 'amount': 1500, 'currency': 'eur',
+        'interval': 'month'})
+    return {'plan': plan['id']}
+
+
+async def create_customer_with_card(client, rng):
+    customer = await client.request('customers.create', 'POST',
+                                    '/v1/customers', {
+                                        'email': 'user%d@example.com'
+                                                 % rng.randrange(10 ** 9),
+                                        'description': 'Benchmark customer'})
+    pm = await client.request('payment_methods.create', 'POST',
+                              '/v1/payment_methods',
+                              {'type': 'card', 'card': CARD})
+    await client.request('payment_methods.attach', 'POST',
+                         '/v1/payment_methods/%s/attach' % pm['id'],
+                         {'customer': customer['id']})
+    await client.request('customers.update', 'POST',
+                         '/v1/customers/%s' % customer['id'],
+                         {'invoice_settings':
+                          {'default_payment_method': pm['id']}})
+    return customer
+
+
+async def subscription(client, context, rng):
+    customer = await create_customer_with_card(client, rng)
+    sub = await client.request('subscriptions.create', 'POST',
+                               '/v1/subscriptions', {
+                                   'customer': customer['id'],
+                                   'items': [{'plan': context['plan']}]})
+    await client.request('invoices.retrieve', 'GET',
+                         '/v1/invoices/%s' % sub['latest_invoice'])
+    await client.request('invoices.list', 'GET', '/v1/invoices',
+                         {'customer': customer['id']})
+    await client.request('invoices.upcoming', 'GET', '/v1/invoices/upcoming',
+                         {'customer': customer['id']})
+
+
+async def invoice_pay(client, context, rng):
+    customer = await create_customer_with_card(client, rng)
+    # (localstripe only creates invoices for subscribed customers.)
+    await client.request('subscriptions.create', 'POST', '/v1/subscriptions',
+                         {'customer': customer['id'],
+                          'items': [{'plan': context['plan']}]})
+    for _ in range(rng.randint(1, 3)):
+        await client.request('invoiceitems.create', 'POST', '/v1/invoiceitems',
+                             {'customer': customer['id'], 'currency': 'eur',
+                              'amount': rng.randint(100, 10000)})
+    invoice = await client.request('invoices.create', 'POST', '/v1/invoices',
+                                   {'customer': customer['id']})
+    await client.request('invoices.pay', 'POST',
+                         '/v1/invoices/%s/pay' % invoice['id'])
+    await client.request('invoices.retrieve', 'GET',
+                         '/v1/invoices/%s' % invoice['id'],
+                         {'expand': ['charge']})
+
+
+async def charge_refund(client, context, rng):
+    token = await client.request('tokens.create', 'POST', '/v1/tokens',
+                                 {'card': CARD})
+    customer = await client.request('customers.create', 'POST',
+                                    '/v1/customers', {'source': token['id']})
+    charge = await client.request('charges.create', 'POST', '/v1/charges', {
+        'customer': customer['id'], 'amount': 2000, 'currency': 'eur'})
+    for amount in (500, 300):
+        await client.request('refunds.create', 'POST', '/v1/refunds',
+                             {'charge': charge['id'], 'amount': amount})
+    await client.request('refunds.list', 'GET', '/v1/refunds',
+                         {'charge': charge['id']})
+
+
+async def list_pagination(client, context, rng):
+    params = {'limit': 20}
+    for _ in range(5):
+        page = await client.request('customers.list', 'GET', '/v1/customers',
+                                    params)
+        if not page['has_more']:
+            break
+        params['starting_after'] = page['data'][-1]['id']
+    await client.request('events.list', 'GET', '/v1/events', {'limit': 20})
+
+
+# Scenarios, with their default weight in the mix:
+SCENARIOS = {
+    'subscription': (subscription, 3),
+    'invoice_pay': (invoice_pay, 2),
+    'charge_refund': (charge_refund, 2),
+    'list_pagination': (list_pagination, 1),
+}
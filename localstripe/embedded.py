@@ -0,0 +1,156 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run localstripe in the same process as Python tests, without HTTP.
+
+    from localstripe.embedded import Client
+
+    client = Client()
+    customer = client.request('POST', '/v1/customers', {'email': 'a@b.c'})
+
+    # or, with stripe-python:
+    stripe.default_http_client = client.stripe_http_client()
+
+Each client works on its own data, kept in memory only. Webhooks are not
+sent."""
+
+import asyncio
+import json
+import pickle
+import random
+from urllib.parse import parse_qsl, urlsplit
+
+from multidict import MultiDict
+
+from .errors import UserError
+from .resources import Store, stores
+from .scheduler import wait_for_pending_tasks
+from .server import parse_authorization, remove_auth_params, \
+    resolve_api_route, unflatten_data
+from .tenants import current_tenant
+from .webhooks import hold_webhooks
+
+
+class Client(object):
+    def __init__(self):
+        self.tenant = 'embedded:%016x' % random.getrandbits(64)
+        stores[self.tenant] = Store(path=None)
+        # Some API calls schedule asynchronous tasks (e.g. SEPA debits). When
+        # called outside of a running event loop, they use this one:
+        self._loop = asyncio.new_event_loop()
+
+    def close(self):
+        stores.pop(self.tenant, None)
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self, func):
+        token = current_tenant.set(self.tenant)
+        try:
+            with hold_webhooks() as events:
+                try:
+                    try:
+                        asyncio.get_running_loop()
+                    except RuntimeError:
+                        async def run():
+                            return func()
+                        return self._loop.run_until_complete(run())
+                    return func()
+                finally:
+                    events.clear()
+        finally:
+            current_tenant.reset(token)
+
+    def request(self, method, path, params=None):
+        """Call the API route for `method` and `path` with already decoded
+        parameters, and return the decoded response. Raise `UserError` on
+        failure, like the HTTP server would respond."""
+        params = dict(params or {})
+        remove_auth_params(params)
+
+        def call():
+            func, match_info = resolve_api_route(method.upper(), path)
+            # Don't give access to internal data, like a JSON response:
+            return pickle.loads(pickle.dumps(func(params, match_info)))
+
+        return self._run(call)
+
+    def flush(self):
+        self._run(stores[self.tenant].clear)
+
+    def wait_for_pending_tasks(self):
+        """Let scheduled work (e.g. SEPA debits) run until it's done."""
+        async def wait():
+            await wait_for_pending_tasks()
+        token = current_tenant.set(self.tenant)
+        try:
+            self._loop.run_until_complete(wait())
+        finally:
+            current_tenant.reset(token)
+
+    def handle_http_request(self, method, url, headers, body=None):
+        """Answer an encoded HTTP request like the server would, and return
+        `(body, status_code, headers)`."""
+        url = urlsplit(url)
+        if body is not None and type(body) is bytes:
+            body = body.decode('utf-8')
+        data = MultiDict(parse_qsl(url.query, keep_blank_values=True))
+        data.extend(parse_qsl(body or '', keep_blank_values=True))
+        params = unflatten_data(data)
+
+        try:
+            authorization = {k.lower(): v for k, v in headers.items()}.get(
+                'authorization', '')
+            if parse_authorization(authorization) is None:
+                raise UserError(401, 'Unauthorized')
+            status, response = 200, self.request(method, url.path, params)
+        except UserError as e:
+            status, response = e.code, e.body
+
+        return (json.dumps(response), status,
+                {'Content-Type': 'application/json'})
+
+    def stripe_http_client(self):
+        """Return an HTTP client for stripe-python, that sends requests to
+        this client instead of the network."""
+        try:
+            from stripe import HTTPClient as StripeHTTPClient
+        except ImportError:  # stripe-python < 8
+            from stripe.http_client import HTTPClient as StripeHTTPClient
+
+        client = self
+
+        class HTTPClient(StripeHTTPClient):
+            name = 'localstripe.embedded'
+
+            def request(self, method, url, headers, post_data=None,
+                        **kwargs):
+                return client.handle_http_request(method, url, headers,
+                                                  post_data)
+
+            def request_stream(self, method, url, headers, post_data=None,
+                               **kwargs):
+                return client.handle_http_request(method, url, headers,
+                                                  post_data)
+
+            def close(self):
+                pass
+
+        return HTTPClient()
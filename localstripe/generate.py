@@ -0,0 +1,302 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generate large synthetic datasets, for testing at scale.
+
+    localstripe generate --customers 100000 --seed my-scenario
+    localstripe  # then serves the generated data
+
+Objects are created through resource classes (like API calls, but without
+HTTP), and written to the file that localstripe loads data from on startup.
+Customers are generated by shards in parallel processes. Each shard is seeded
+from the seed and its index, so that the same seed and shape give the same
+objects, whatever the number of processes (only dates depend on the time of
+generation)."""
+
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import time
+
+from .resources import Balance, Charge, Customer, Invoice, PaymentMethod, \
+    Plan, Product, Refund, Store, Subscription, TaxRate, Token, store, \
+    store_path, stores
+from .scheduler import wait_for_pending_tasks
+from .tenants import current_tenant
+from .webhooks import hold_webhooks
+
+
+# Customers generated by each process at a time:
+SHARD_SIZE = 1000
+
+# Shape of generated data. Values of `sources` and `subscriptions` are
+# relative weights; ranges are inclusive.
+DEFAULT_SHAPE = {
+    'customers': 1000,
+    'products': 10,
+    # Plans per product, a part of them with tiered pricing:
+    'plans_per_product': 3,
+    'tiered_plans': 0.3,
+    'tax_rates': 3,
+    'sources': {'card': 6, 'legacy_card': 2, 'sepa_debit': 1, 'none': 1},
+    # Customers without a payment source only get trialing subscriptions:
+    'subscriptions': {'none': 4, 'active': 10, 'trialing': 2, 'past_due': 1,
+                      'unpaid': 1, 'incomplete': 1, 'incomplete_expired': 1,
+                      'canceled': 2},
+    # One-time charges of customers with a legacy card source, and the part
+    # of them that is partially refunded:
+    'charges_per_customer': [0, 3],
+    'refunded_charges': 0.2,
+}
+
+CARD_NUMBERS = ('4242424242424242', '4000056655665556', '5555555555554444')
+# Accepted when attached, but declined when charged:
+DECLINED_CARD_NUMBER = '4000000000000341'
+IBAN = 'DE89370400440532013000'
+
+
+def _card(rng, number=None):
+    return {'number': number or rng.choice(CARD_NUMBERS),
+            'exp_month': rng.randint(1, 12),
+            'exp_year': rng.randint(2030, 2035),
+            'cvc': '%03d' % rng.randrange(1000)}
+
+
+def _choose(rng, weights):
+    return rng.choices(list(weights), list(weights.values()))[0]
+
+
+def generate_catalog(shape, rng):
+    """Create products, plans and tax rates, shared by all customers."""
+    Balance._api_retrieve()
+    for i in range(shape['tax_rates']):
+        TaxRate._api_create(display_name='VAT', inclusive=False,
+                            percentage=rng.choice((5.5, 10.0, 20.0)),
+                            jurisdiction='EU', description='Tax %d' % i)
+    for i in range(shape['products']):
+        product = Product._api_create(name='Product %d' % i, type='service')
+        for j in range(shape['plans_per_product']):
+            interval = rng.choice(('month', 'year'))
+            if rng.random() < shape['tiered_plans']:
+                tiers = [{'up_to': up_to,
+                          'unit_amount': rng.randint(100, 1000) // (k + 1),
+                          'flat_amount': rng.choice((0, 500))}
+                         for k, up_to in enumerate((10, 50, 100))]
+                tiers.append({'up_to': 'inf', 'unit_amount': 50})
+                Plan._api_create(
+                    product=product.id, currency='eur', interval=interval,
+                    nickname='Tiered %d' % j, billing_scheme='tiered',
+                    tiers_mode=rng.choice(('volume', 'graduated')),
+                    tiers=tiers)
+            else:
+                Plan._api_create(
+                    product=product.id, currency='eur', interval=interval,
+                    nickname='Plan %d' % j,
+                    amount=rng.randint(1, 100) * 100)
+
+
+def generate_customer(shape, rng, plans, index):
+    customer = Customer._api_create(
+        email='customer%d@example.com' % index,
+        name='Customer %d' % index,
+        metadata={'index': str(index)})
+
+    source = _choose(rng, shape['sources'])
+    status = _choose(rng, shape['subscriptions'])
+    if status in ('incomplete', 'incomplete_expired'):
+        # (Whatever the source, so that the first payment fails.)
+        pm = PaymentMethod._api_create(
+            type='card', card=_card(rng, DECLINED_CARD_NUMBER))
+    elif source == 'card':
+        pm = PaymentMethod._api_create(type='card', card=_card(rng))
+    elif source == 'sepa_debit':
+        pm = PaymentMethod._api_create(type='sepa_debit',
+                                       sepa_debit={'iban': IBAN})
+    else:
+        pm = None
+    if pm is not None:
+        PaymentMethod._api_attach(pm.id, customer=customer.id)
+        Customer._api_update(customer.id, invoice_settings={
+            'default_payment_method': pm.id})
+    elif source == 'legacy_card':
+        token = Token._api_create(card=_card(rng))
+        Customer._api_add_source(customer.id, source=token.id)
+    elif status != 'trialing':
+        status = 'none'
+
+    if status != 'none':
+        plan = rng.choice(plans)
+        quantity = rng.randint(1, 150 if plan.tiers else 3)
+        sub = Subscription._api_create(
+            customer=customer.id,
+            items=[{'plan': plan.id, 'quantity': quantity}],
+            trial_period_days=14 if status == 'trialing' else None,
+            enable_incomplete_payments=status.startswith('incomplete'))
+        if status == 'incomplete_expired':
+            Invoice._api_void_invoice(sub.latest_invoice)
+        elif status == 'canceled':
+            Subscription._api_delete(sub.id)
+        elif status in ('trialing', 'past_due', 'unpaid'):
+            # localstripe doesn't go through these statuses by itself:
+            sub.status = status
+
+    if source == 'legacy_card' and pm is None:
+        for _ in range(rng.randint(*shape['charges_per_customer'])):
+            charge = Charge._api_create(customer=customer.id, currency='eur',
+                                        amount=rng.randint(5, 500) * 100)
+            if rng.random() < shape['refunded_charges']:
+                Refund._api_create(charge=charge.id,
+                                   amount=charge.amount // 2)
+
+
+async def _generate_shard(shape, seed, shard, catalog):
+    random.seed('%s:%d' % (seed, shard))  # for IDs of objects
+    rng = random.Random('%s:%d' % (seed, shard))
+    plans = [obj for key, obj in catalog.items() if key.startswith('plan:')]
+    start = shard * SHARD_SIZE
+    with hold_webhooks() as events:
+        for index in range(start, min(start + SHARD_SIZE, shape['customers'])):
+            generate_customer(shape, rng, plans, index)
+        # e.g. SEPA debits:
+        await wait_for_pending_tasks()
+        events.clear()
+
+
+def generate_shard(args):
+    """Generate customers of a shard, and their objects, on top of the
+    catalog. Return new objects, pickled with references to objects of the
+    catalog (see `_load_shard()`)."""
+    shape, seed, shard, catalog_snapshot = args
+    tenant = 'generate:%d' % shard
+    stores[tenant] = Store(path=None)
+    token = current_tenant.set(tenant)
+    try:
+        stores[tenant].restore(catalog_snapshot)
+        catalog = dict(stores[tenant])
+        asyncio.run(_generate_shard(shape, seed, shard, catalog))
+
+        f = io.BytesIO()
+        _ShardPickler(f, catalog).dump(
+            {key: obj for key, obj in stores[tenant].items()
+             if key not in catalog})
+        return f.getvalue()
+    finally:
+        current_tenant.reset(token)
+        del stores[tenant]
+
+
+class _ShardPickler(pickle.Pickler):
+    """Pickle objects of the catalog as references (their key in the
+    store), so that once loaded, new objects use the objects of the catalog
+    in the main process (e.g. plans of subscription items), not copies."""
+
+    def __init__(self, file, catalog):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._catalog_keys = {id(obj): key for key, obj in catalog.items()}
+
+    def persistent_id(self, obj):
+        return self._catalog_keys.get(id(obj))
+
+
+class _ShardUnpickler(pickle.Unpickler):
+    def __init__(self, file, catalog):
+        super().__init__(file)
+        self._catalog = catalog
+
+    def persistent_load(self, key):
+        return self._catalog[key]
+
+
+def generate(shape, seed, jobs):
+    """Generate a dataset into the store of the current tenant."""
+    random.seed('%s:catalog' % seed)
+    with hold_webhooks() as events:
+        generate_catalog(shape, random.Random('%s:catalog' % seed))
+        events.clear()
+    catalog = dict(store)
+    snapshot = store.snapshot()
+
+    shards = range((shape['customers'] + SHARD_SIZE - 1) // SHARD_SIZE)
+    with multiprocessing.Pool(jobs) as pool:
+        for data in pool.imap(generate_shard, [(shape, seed, shard, snapshot)
+                                               for shard in shards]):
+            store.update(
+                _ShardUnpickler(io.BytesIO(data), catalog).load())
+
+    # Shards updated their own copy of the balance, compute it again (now,
+    # so that it is stored with its totals):
+    balance = Balance._api_retrieve()
+    balance._totals = None
+    balance._get_totals()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='localstripe generate',
+        description='Generate a large synthetic dataset, and write it where '
+                    'localstripe loads data from.')
+    parser.add_argument('--shape', metavar='FILE',
+                        help='JSON file with the shape of data, overriding '
+                             'defaults: ' + json.dumps(DEFAULT_SHAPE))
+    parser.add_argument('--customers', type=int,
+                        help='number of customers (overrides --shape)')
+    parser.add_argument('--seed', default='localstripe',
+                        help='same seed and shape give the same data')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--account', default='',
+                        help='generate data of this Stripe-Account (default: '
+                             'data used without a Stripe-Account header)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write to this file instead of the one that '
+                             'localstripe loads the data of the account from')
+    args = parser.parse_args(argv)
+
+    shape = dict(DEFAULT_SHAPE)
+    if args.shape:
+        with open(args.shape) as f:
+            custom = json.load(f)
+        unknown = set(custom) - set(DEFAULT_SHAPE)
+        if unknown:
+            parser.error('unknown keys in --shape: ' + ', '.join(unknown))
+        shape.update(custom)
+    if args.customers is not None:
+        shape['customers'] = args.customers
+    if shape['customers'] < 0:
+        parser.error('the number of customers must be positive')
+    if args.jobs < 1:
+        parser.error('--jobs must be positive')
+
+    start = time.perf_counter()
+    stores[args.account] = Store(path=args.output or
+                                 store_path(args.account))
+    current_tenant.set(args.account)
+    with store.deferred_dumps():
+        generate(shape, args.seed, args.jobs)
+    store.dump_to_disk()
+
+    counts = {}
+    for key in store:
+        object = key.split(':', 1)[0]
+        counts[object] = counts.get(object, 0) + 1
+    print('generated %d objects in %.1f s, written to %s'
+          % (sum(counts.values()), time.perf_counter() - start, store.path))
+    for object, count in sorted(counts.items()):
+        print('  %s: %d' % (object, count))
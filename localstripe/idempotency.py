@@ -0,0 +1,110 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import hashlib
+import time
+
+from .errors import UserError
+
+
+# Like on Stripe:
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyCache(object):
+    """LRU cache of responses to requests with an `Idempotency-Key` header,
+    so that retried requests get the same response, without being handled
+    again (and creating objects twice).
+
+    Entries are keyed on the scope of the key (tenant and API key) and the
+    key itself, and expire after `ttl` seconds (24 hours, like on Stripe).
+    They remember a fingerprint of the request, so that a key cannot be
+    reused for another request."""
+
+    def __init__(self, maxsize=10000, ttl=24 * 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # `(scope, key)` -> `[expiration, fingerprint, response]`, where
+        # `response` is `(status, body, content_type)`, or `None` while the
+        # first request is being handled:
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def fingerprint(path, body):
+        return hashlib.sha256(path.encode('utf-8') + b'\0' + body).digest()
+
+    def begin(self, scope, key, fingerprint):
+        """Return the cached response for this key, if any. Otherwise, reserve
+        the key until `finish()` or `abort()` is called, and return `None`."""
+        if len(key) > MAX_KEY_LENGTH:
+            raise UserError(400, 'Idempotency-Key must be at most %d '
+                                 'characters long' % MAX_KEY_LENGTH)
+
+        now = time.monotonic()
+        entry = self._entries.get((scope, key))
+        if entry is not None and entry[0] <= now:
+            del self._entries[(scope, key)]
+            entry = None
+
+        if entry is None:
+            self._entries[(scope, key)] = [now + self.ttl, fingerprint, None]
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return None
+
+        self._entries.move_to_end((scope, key))
+        if entry[1] != fingerprint:
+            error = UserError(
+                400, 'Keys for idempotent requests can only be used with the '
+                     'same parameters they were first used with. Try using a '
+                     "key other than '%s' if you meant to execute a "
+                     'different request.' % key)
+            error.body['error']['type'] = 'idempotency_error'
+            raise error
+        if entry[2] is None:
+            raise UserError(
+                409, 'There is currently another in-progress request using '
+                     'this Idempotency-Key (that probably means you submitted '
+                     'twice, and the other request is still going through): '
+                     "'%s'. Please try again later." % key,
+                {'code': 'idempotency_key_in_use'})
+        return entry[2]
+
+    def finish(self, scope, key, status, body, content_type):
+        entry = self._entries.get((scope, key))
+        if entry is not None:  # unless evicted in the meantime
+            entry[2] = (status, body, content_type)
+
+    def abort(self, scope, key):
+        """Forget the key, e.g. when handling the request failed
+        unexpectedly, so that it can be retried."""
+        entry = self._entries.get((scope, key))
+        if entry is not None and entry[2] is None:
+            del self._entries[(scope, key)]
+
+    def clear(self, tenant=None):
+        if tenant is None:
+            self._entries.clear()
+        else:
+            for scope, key in list(self._entries):
+                if scope[0] == tenant:
+                    del self._entries[(scope, key)]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+idempotency_cache = IdempotencyCache()
@@ -0,0 +1,109 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import sys
+import tracemalloc
+import types
+
+
+# Shared by all objects, and not part of their data:
+_not_data = (type, types.ModuleType, types.FunctionType, types.MethodType,
+             types.BuiltinFunctionType)
+
+# Snapshot taken by the previous call of `tracemalloc_diff()`:
+_tracemalloc_snapshot = None
+
+
+def _retained_size(root, stored, seen):
+    """Approximate size of `root` and the objects it references, in bytes.
+    Other stored objects (in `stored`) and objects already counted (in
+    `seen`, e.g. shared strings) are not counted."""
+    size = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if (id(obj) in seen or isinstance(obj, _not_data) or
+                (obj is not root and id(obj) in stored)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return size
+
+
+def memory_stats(stores, limit=10):
+    """Return counts and approximate retained bytes of stored objects by type,
+    the `limit` largest objects, and the size of stored data once pickled."""
+    stored = {id(obj)
+              for tenant_store in stores.values()
+              for obj in tenant_store.values()}
+    seen = set()
+    by_type = {}
+    sizes = []
+    pickle_bytes = 0
+    for tenant, tenant_store in list(stores.items()):
+        for key, obj in tenant_store.items():
+            size = _retained_size(obj, stored, seen)
+            # Keys are like `customer:cus_...`, or just `balance`:
+            type, _, object_id = key.partition(':')
+            stats = by_type.setdefault(type, {'count': 0, 'bytes': 0})
+            stats['count'] += 1
+            stats['bytes'] += size
+            sizes.append((size, tenant, type, object_id or key))
+        pickle_bytes += len(tenant_store.snapshot())
+
+    return {
+        'objects': by_type,
+        'total_bytes': sum(stats['bytes'] for stats in by_type.values()),
+        'largest': [{'bytes': size, 'tenant': tenant, 'id': object_id,
+                     'object': type}
+                    for size, tenant, type, object_id
+                    in heapq.nlargest(limit, sizes)],
+        'pickle_bytes': pickle_bytes,
+    }
+
+
+def tracemalloc_diff(limit=10):
+    """Start tracing memory allocations, or if already started, return the
+    `limit` source lines which allocated the most memory since the previous
+    call."""
+    global _tracemalloc_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    previous, _tracemalloc_snapshot = \
+        _tracemalloc_snapshot, tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+    if previous is None:
+        return []
+
+    return [{'file': stat.traceback[0].filename,
+             'line': stat.traceback[0].lineno,
+             'size': stat.size, 'size_diff': stat.size_diff,
+             'count': stat.count, 'count_diff': stat.count_diff}
+            for stat in _tracemalloc_snapshot.compare_to(
+                previous, 'lineno')[:limit]]
+
+
+def stop_tracemalloc():
+    global _tracemalloc_snapshot
+    _tracemalloc_snapshot = None
+    tracemalloc.stop()
@@ -0,0 +1,119 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+
+
+# Metrics, in the order they are exported:
+_metrics = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def _samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Gauge(object):
+    """Gauge whose values are read from `func` when exported. `func` returns
+    a number, or a dict of numbers by tuple of label values."""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, func, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._func = func
+        _metrics.append(self)
+
+    def _samples(self):
+        values = self._func()
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    # in seconds, like the Prometheus client libraries:
+    default_buckets = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5,
+                       5, 7.5, 10)
+
+    def __init__(self, name, help, labelnames=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # By tuple of label values: count in each bucket (not cumulated, the
+        # last one is for `+Inf`), and sum of observed values.
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def _samples(self):
+        for labels, (counts, sum) in sorted(self._values.items()):
+            cumulated = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulated += count
+                yield (self.name + '_bucket',
+                       _format_labels(self.labelnames, labels,
+                                      (('le', bound),)),
+                       cumulated)
+            yield (self.name + '_sum',
+                   _format_labels(self.labelnames, labels), sum)
+            yield (self.name + '_count',
+                   _format_labels(self.labelnames, labels), cumulated)
+
+
+def export_metrics():
+    """Return all metrics in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for name, labels, value in metric._samples():
+            lines.append('%s%s %s' % (name, labels, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,157 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+from collections import OrderedDict
+import io
+import itertools
+import marshal
+import os.path
+import pstats
+import random
+import time
+
+
+# Profiles are kept in memory, so only the last ones are kept:
+MAX_PROFILES = 20
+
+settings = {'enabled': False, 'sample_rate': 1.0}
+_profiles = OrderedDict()
+_ids = itertools.count(1)
+# cProfile profiles everything running in the thread, so only one request is
+# profiled at a time:
+_running = False
+
+
+class Profile(object):
+    def __init__(self, id):
+        self.id = id
+        self.method = None
+        self.path = None
+        self.route = None
+        self.status = None
+        self.created = int(time.time())
+        self.duration = None
+        self._profile = cProfile.Profile()
+        self._start = None
+
+    def summary(self):
+        return {'id': self.id, 'method': self.method, 'path': self.path,
+                'route': self.route, 'status': self.status,
+                'created': self.created, 'duration': self.duration}
+
+    def _stats(self):
+        # `pstats.Stats` takes the stats of a profile away, so build them for
+        # each use:
+        self._profile.create_stats()
+        return self._profile.stats
+
+    def to_text(self):
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(50)
+        return stream.getvalue()
+
+    def to_pstats(self):
+        """Return the profile like `cProfile.Profile.dump_stats()` writes it,
+        for `pstats.Stats` or other tools (snakeviz...)."""
+        return marshal.dumps(self._stats())
+
+    def to_collapsed(self):
+        """Return the profile as collapsed stacks (for flame graph tools),
+        with microseconds of own time. cProfile only records callers of each
+        function, so stacks are derived from the call graph, sharing the time
+        of a function between its callers."""
+        stats = self._stats()
+        callees = {}
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            for caller, (_, _, _, edge_ct) in callers.items():
+                callees.setdefault(caller, []).append((func, edge_ct))
+
+        def label(func):
+            filename, line, name = func
+            if filename == '~':  # built-in
+                return name
+            return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+        lines = {}
+
+        def walk(func, stack, share):
+            stack = stack + (func,)
+            own = stats[func][2] * share * 1e6
+            if own >= 1:
+                key = ';'.join(label(f) for f in stack)
+                lines[key] = lines.get(key, 0) + own
+            for callee, edge_ct in callees.get(func, ()):
+                callee_ct = stats[callee][3]
+                # Skip recursive calls, and negligible branches:
+                if (callee in stack or callee_ct <= 0 or
+                        edge_ct * share * 1e6 < 1):
+                    continue
+                walk(callee, stack, share * edge_ct / callee_ct)
+
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            if not callers:
+                walk(func, (), 1)
+
+        return ''.join('%s %d\n' % (key, value)
+                       for key, value in sorted(lines.items()))
+
+
+def start_profile(forced=False):
+    """Start profiling a request if it is forced or sampled, and if no other
+    request is being profiled. Return the profile, or `None`."""
+    global _running
+    if _running:
+        return None
+    if not forced and not (settings['enabled'] and
+                           random.random() < settings['sample_rate']):
+        return None
+
+    profile = Profile('prof_%d' % next(_ids))
+    try:
+        profile._profile.enable()
+    except ValueError:  # another profiler is active
+        return None
+    _running = True
+    profile._start = time.perf_counter()
+    return profile
+
+
+def stop_profile(profile, method, path, route, status):
+    global _running
+    profile._profile.disable()
+    _running = False
+    profile.duration = time.perf_counter() - profile._start
+    profile.method = method
+    profile.path = path
+    profile.route = route
+    profile.status = status
+
+    _profiles[profile.id] = profile
+    while len(_profiles) > MAX_PROFILES:
+        _profiles.popitem(last=False)
+
+
+def list_profiles():
+    return [profile.summary() for profile in reversed(_profiles.values())]
+
+
+def get_profile(id):
+    return _profiles.get(id)
+
+
+def clear_profiles():
+    _profiles.clear()
@@ -0,0 +1,297 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Record API requests, and replay them against another localstripe.
+
+    localstripe --record /tmp/requests.ndjson
+    localstripe replay /tmp/requests.ndjson --url http://localhost:8421
+
+Requests are recorded as newline-delimited JSON, one line per request, like:
+
+    {"t":1792408115.123,"method":"POST","path":"/v1/customers",
+     "params":{"email":"a@b.c"},"headers":{"Authorization":"Bearer sk_..."},
+     "status":200,"duration":3.21,"ids":[["id","cus_..."]]}
+
+where `t` is the time the request was received, `duration` the time spent
+handling it in milliseconds, and `ids` the IDs that appeared for the first
+time in the response, with their path in it. When replayed, objects get other
+IDs: they are found at the same paths in responses, and replaced in the
+following requests."""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+import aiohttp
+
+
+# Headers which change how requests are handled:
+RECORDED_HEADERS = ('Authorization', 'Idempotency-Key', 'Stripe-Account',
+                    'Stripe-Version')
+
+# IDs of objects (e.g. `cus_6XhKBbmALMAsBi`), see `resources.random_id()`:
+ID_PATTERN = re.compile(r'(?<![\w])[a-z]+_[A-Za-z0-9]{14,}')
+
+
+class Recorder(object):
+    def __init__(self, path):
+        # Lines are written at once at the end of the file, so that processes
+        # can record to the same file (see `--workers`):
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0o600)
+        self._known_ids = set()
+
+    def record(self, start, method, path, params, headers, status, duration,
+               body=None):
+        entry = {'t': round(start, 3), 'method': method, 'path': path}
+        if params:
+            entry['params'] = params
+        if headers:
+            entry['headers'] = headers
+        entry['status'] = status
+        entry['duration'] = round(1000 * duration, 3)
+        if body is not None:
+            # IDs given in the request are not new:
+            self._known_ids.update(ID_PATTERN.findall(
+                json.dumps([path, params], default=str)))
+            ids = self._new_ids(json.loads(body))
+            if ids:
+                entry['ids'] = ids
+        line = json.dumps(entry, separators=(',', ':'), default=str) + '\n'
+        os.write(self._fd, line.encode('utf-8'))
+
+    def _new_ids(self, value, path=()):
+        ids = []
+        if type(value) is dict:
+            for key, item in value.items():
+                ids.extend(self._new_ids(item, path + (key,)))
+        elif type(value) is list:
+            for i, item in enumerate(value):
+                ids.extend(self._new_ids(item, path + (str(i),)))
+        elif (type(value) is str and ID_PATTERN.fullmatch(value) and
+                value not in self._known_ids):
+            self._known_ids.add(value)
+            ids.append(['.'.join(path), value])
+        return ids
+
+
+def encode_params(params, prefix=None):
+    """Encode parameters like Stripe clients do, e.g. `items[0][plan]=x`."""
+    if type(params) is list:
+        items = enumerate(params)
+    else:
+        items = params.items()
+    for key, value in items:
+        name = key if prefix is None else '%s[%s]' % (prefix, key)
+        if type(value) in (dict, list):
+            yield from encode_params(value, name)
+        elif type(value) is bool:
+            yield name, 'true' if value else 'false'
+        elif value is None:
+            yield name, ''
+        else:
+            yield name, str(value)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(p / 100 * len(sorted_values)))]
+
+
+def read_recording(f):
+    entries = []
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            # The recording server may have been stopped while writing:
+            print('ignoring line %d, which is not valid JSON' % number,
+                  file=sys.stderr)
+    return entries
+
+
+def replace_ids(value, ids):
+    if type(value) is dict:
+        return {key: replace_ids(item, ids) for key, item in value.items()}
+    elif type(value) is list:
+        return [replace_ids(item, ids) for item in value]
+    elif type(value) is str:
+        return ID_PATTERN.sub(lambda m: ids.get(m.group(0), m.group(0)),
+                              value)
+    return value
+
+
+def find_path(value, path):
+    for key in path.split('.') if path else ():
+        if type(value) is dict:
+            value = value.get(key)
+        elif type(value) is list and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return None
+    return value
+
+
+async def replay(entries, url, session, fast=False, speed=1, concurrency=10):
+    """Send recorded requests, and return the status and latency (in seconds)
+    of each. Even when sent concurrently, requests on the same objects (i.e.
+    which use or return the same IDs) are sent in the recorded order, each
+    once the previous one is done."""
+    # Recorded IDs, by index of the request which returned them first:
+    producers = {}
+    # Indexes of the previous requests on the same objects, by request:
+    previous = [set() for _ in entries]
+    last_use = {}
+    for i, entry in enumerate(entries):
+        for _, id in entry.get('ids', ()):
+            producers.setdefault(id, i)
+        used = ID_PATTERN.findall(json.dumps(
+            [entry['path'], entry.get('params')]))
+        for id in used + [id for _, id in entry.get('ids', ())]:
+            if id in last_use:
+                previous[i].add(last_use[id])
+            last_use[id] = i
+    # Recorded IDs, and the ones of objects created by the replay:
+    ids = {}
+    done = [asyncio.Event() for _ in entries]
+    results = [None] * len(entries)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def send(i, entry):
+        try:
+            for j in previous[i]:
+                await done[j].wait()
+            params = list(encode_params(
+                replace_ids(entry.get('params') or {}, ids)))
+            query = params if entry['method'] in ('GET', 'DELETE') else None
+            start = time.perf_counter()
+            try:
+                async with session.request(
+                        entry['method'], url + replace_ids(entry['path'], ids),
+                        headers=entry.get('headers'), params=query,
+                        data=params if query is None else None) as r:
+                    body = await r.read()
+            except aiohttp.ClientError:
+                results[i] = (None, time.perf_counter() - start)
+                return
+            results[i] = (r.status, time.perf_counter() - start)
+            if r.status == 200 and entry.get('ids'):
+                response = json.loads(body)
+                for path, id in entry['ids']:
+                    new_id = find_path(response, path)
+                    # (Processes recording requests don't know which IDs
+                    # others saw, so the same ID can be recorded again later,
+                    # e.g. in a list whose order depends on concurrency.)
+                    if type(new_id) is str and producers[id] == i:
+                        ids[id] = new_id
+        finally:
+            done[i].set()
+            slots.release()
+
+    tasks = []
+    start = time.perf_counter()
+    for i, entry in enumerate(entries):
+        if not fast:
+            delay = (entry['t'] - entries[0]['t']) / speed
+            await asyncio.sleep(start + delay - time.perf_counter())
+        # (Waiting for a free slot can delay the following requests.)
+        await slots.acquire()
+        tasks.append(asyncio.ensure_future(send(i, entry)))
+    await asyncio.gather(*tasks)
+    return results
+
+
+def summarize(entries, results, elapsed):
+    latencies = sorted(latency for _, latency in results)
+    recorded = sorted(entry['duration'] / 1000 for entry in entries)
+    mismatches = [(entry['method'], entry['path'], entry['status'], status)
+                  for entry, (status, _) in zip(entries, results)
+                  if status != entry['status']]
+    return {
+        'requests': len(entries),
+        'elapsed': elapsed,
+        'requests_per_second': len(entries) / elapsed if elapsed else None,
+        'different_status': len(mismatches),
+        'different_status_examples': mismatches[:10],
+        # Recorded durations are measured by the server, replayed latencies
+        # by the client, so they also include network and HTTP parsing:
+        'recorded_ms': {'p%d' % p: 1000 * (percentile(recorded, p) or 0)
+                        for p in (50, 90, 99)},
+        'replayed_ms': {'p%d' % p: 1000 * (percentile(latencies, p) or 0)
+                        for p in (50, 90, 99)},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='localstripe replay',
+        description='Send requests recorded with --record to a running '
+                    'localstripe (preferably started with --from-scratch).')
+    parser.add_argument('file', help='recorded requests')
+    parser.add_argument('--url', default='http://localhost:8420')
+    parser.add_argument('--unix-socket', metavar='PATH',
+                        help='connect to this unix socket')
+    parser.add_argument('--fast', action='store_true',
+                        help='send requests as fast as possible, instead of '
+                             'at the recorded pace')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='speed compared to the recorded pace (e.g. 2 for '
+                             'twice as fast)')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='maximum number of requests sent at the same '
+                             'time')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write results to this file')
+    args = parser.parse_args(argv)
+    if args.speed <= 0 or args.concurrency < 1:
+        parser.error('--speed and --concurrency must be positive')
+
+    with open(args.file) as f:
+        entries = read_recording(f)
+
+    async def run():
+        connector = None
+        if args.unix_socket:
+            connector = aiohttp.UnixConnector(path=args.unix_socket)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await replay(entries, args.url.rstrip('/'), session,
+                                fast=args.fast, speed=args.speed,
+                                concurrency=args.concurrency)
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    summary = summarize(entries, results, time.perf_counter() - start)
+
+    print('%d requests replayed in %.1f s (%.1f/s), %d with a different '
+          'status' % (summary['requests'], summary['elapsed'],
+                      summary['requests_per_second'] or 0,
+                      summary['different_status']))
+    for method, path, recorded, status in \
+            summary['different_status_examples']:
+        print('  %s %s: %s instead of %s' % (method, path, status, recorded))
+    for key in ('recorded_ms', 'replayed_ms'):
+        print('%s: %s' % (key, ', '.join(
+            '%s %.2f' % item for item in summary[key].items())))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
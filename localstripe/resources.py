@@ -13,10 +13,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from array import array
 import asyncio
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from decimal import Decimal, ROUND_HALF_UP
 import hashlib
+import json
 import pickle
 import random
 import re
@@ -26,6 +31,10 @@ import time
 from dateutil.relativedelta import relativedelta
 
 from .errors import UserError
+from .metrics import Counter, Histogram
+from .scheduler import schedule
+from .tenants import current_tenant
+from .tracing import span
 from .webhooks import schedule_webhook
 
 
@@ -34,38 +43,260 @@ from .webhooks import schedule_webhook
 _type = type
 
 
+dump_duration = Histogram('localstripe_store_dump_duration_seconds',
+                          'Time spent dumping stored data to disk.')
+dump_bytes = Counter('localstripe_store_dump_bytes_total',
+                     'Bytes written when dumping stored data to disk.')
+
+
 class Store(dict):
-    def __init__(self, *args, **kwargs):
+    _dumps_deferred = 0
+    # Objects by type, like `{'customer': {'customer:cus_123': <Customer>}}`,
+    # so that listing objects of a type doesn't go through the whole store:
+    _by_type = None
+
+    def __init__(self, *args, path='/tmp/localstripe.pickle', **kwargs):
         super().__init__(*args, **kwargs)
+        self.path = path
+        self._by_type = {}
+        # Objects of different tenants can have the same IDs (e.g. generated
+        # with the same seed), so each store has its own cache:
+        self.preview_cache = PreviewCache()
+        for key, value in self.items():
+            self._index(key, value)
+
+    def _index(self, key, value):
+        if self._by_type is None:  # being unpickled, see `__reduce__()`
+            return
+        self._by_type.setdefault(key.split(':', 1)[0], {})[key] = value
+
+    def of_type(self, object):
+        return list(self._by_type.get(object, {}).values())
+
+    def __reduce__(self):
+        # Pickle as a plain dict: unpickling a `Store` would otherwise call
+        # `__setitem__()` for each item, and dump to the file being loaded.
+        # (Files written by previous versions still do so, hence the check on
+        # `_by_type` in `dump_to_disk()`.)
+        return Store, (dict(self),)
 
     def try_load_from_disk(self):
+        if self.path is None:
+            return
         try:
-            with open('/tmp/localstripe.pickle', 'rb') as f:
+            with open(self.path, 'rb') as f:
                 old = pickle.load(f)
                 self.clear()
                 self.update(old)
         except FileNotFoundError:
             pass
 
+    def snapshot(self):
+        return pickle.dumps(dict(self), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def restore(self, snapshot):
+        self.clear()
+        self.update(pickle.loads(snapshot))
+
     def dump_to_disk(self):
-        with open('/tmp/localstripe.pickle', 'wb') as f:
+        if (self._dumps_deferred or self._by_type is None or
+                self.path is None):
+            return
+        start = time.perf_counter()
+        with span('dump'), open(self.path, 'wb') as f:
             pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
-
-    def __setitem__(self, *args, **kwargs):
-        super().__setitem__(*args, **kwargs)
+            size = f.tell()
+        dump_duration.observe(time.perf_counter() - start)
+        dump_bytes.inc(value=size)
+
+    @contextmanager
+    def deferred_dumps(self):
+        """Don't dump to disk on each change within this context. The caller
+        is responsible for calling `dump_to_disk()` afterwards."""
+        self._dumps_deferred += 1
+        try:
+            yield
+        finally:
+            self._dumps_deferred -= 1
+
+    def clear(self):
+        super().clear()
+        self._by_type = {}
+        self.preview_cache.clear()
+
+    def update(self, other):
+        super().update(other)
+        for key, value in other.items():
+            self._index(key, value)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._index(key, value)
         self.dump_to_disk()
 
-    def __delitem__(self, *args, **kwargs):
-        super().__delitem__(*args, **kwargs)
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self._by_type[key.split(':', 1)[0]][key]
         self.dump_to_disk()
 
 
-store = Store()
+def store_path(tenant):
+    """File where data of `tenant` is persisted."""
+    if not tenant:
+        return '/tmp/localstripe.pickle'
+    # Tenant names come from API keys and headers, don't put them in file
+    # names as is:
+    digest = hashlib.sha256(tenant.encode('utf-8')).hexdigest()
+    return '/tmp/localstripe-%s.pickle' % digest[:16]
+
+
+class TenantStores(dict):
+    """Stores by tenant name, created when first used."""
+
+    def __init__(self):
+        super().__init__()
+        self.load_from_disk = False
+
+    def __missing__(self, tenant):
+        store = Store(path=store_path(tenant))
+        if self.load_from_disk:
+            store.try_load_from_disk()
+        self[tenant] = store
+        return store
+
+
+stores = TenantStores()
+
+
+class CurrentStore(object):
+    """Store of the current tenant, see `tenants.current_tenant`."""
+
+    def _get(self):
+        return stores[current_tenant.get()]
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __setitem__(self, key, value):
+        self._get()[key] = value
+
+    def __delitem__(self, key):
+        del self._get()[key]
+
+    def __contains__(self, key):
+        return key in self._get()
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+
+store = CurrentStore()
+
+
+class PreviewCache(object):
+    """LRU cache of upcoming and preview invoices.
+
+    Entries are keyed on the request parameters, and are only valid for the
+    version of the billing state they were computed from. Objects that
+    previews depend on (customers, subscriptions, invoice items, plans,
+    coupons, tax rates...) bump these versions when they change, see
+    `StripeObject._on_change()`.
+
+    Upcoming invoices of a given subscription are dated from its billing
+    period, but other ones (see `cached_preview()`) have lines dated from the
+    current time, in seconds: their entries are only valid during the second
+    they were computed in. (The `created` date of a cached preview is the one
+    of its computation.)"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Version counters, by customer ID. The `None` key is for state shared
+        # by all customers, like plans and tax rates.
+        self._versions = {}
+
+    def invalidate(self, customer=None):
+        self._versions[customer] = self._versions.get(customer, 0) + 1
+
+    def forget(self, customer):
+        """Drop the version counter and entries of a deleted customer, so
+        that they don't pile up."""
+        self._versions.pop(customer, None)
+        for key in [key for key in self._entries if key[0] == customer]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+        self._versions.clear()
+
+    def _version(self, customer):
+        return self._versions.get(None, 0), self._versions.get(customer, 0)
+
+    def get(self, customer, params, compute, timed=False):
+        if type(customer) is not str:
+            return compute()  # let `compute` fail with a proper error
+
+        key = (customer, json.dumps(params, sort_keys=True))
+        entry = self._entries.get(key)
+        if (entry is not None and entry[0] == self._version(customer) and
+                entry[1] in (None, int(time.time()))):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+        self.misses += 1
+        now = int(time.time()) if timed else None
+        result = compute()
+        # Computing a preview creates throw-away objects (subscription items,
+        # line items...) that bump the version, so take it afterwards:
+        self._entries[key] = (self._version(customer), now, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return result
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class CurrentPreviewCache(object):
+    """Preview cache of the current tenant's store."""
+
+    def __getattr__(self, name):
+        return getattr(store.preview_cache, name)
+
+
+preview_cache = CurrentPreviewCache()
+
+
+def cached_preview(simulated_by):
+    """Cache previews computed by the decorated method. Lines of previews
+    are dated from the current time, unless they are for a given
+    subscription, without simulated changes (any of the `simulated_by`
+    parameters)."""
+    def decorator(func):
+        def wrapper(cls, **kwargs):
+            timed = (kwargs.get('subscription') is None or
+                     any(kwargs.get(name) is not None
+                         for name in simulated_by))
+            return preview_cache.get(kwargs.get('customer'),
+                                     (func.__name__, kwargs),
+                                     lambda: func(cls, **kwargs), timed)
+        return wrapper
+    return decorator
 
 
 def random_id(n):
-    return ''.join(random.choice(string.ascii_letters + string.digits)
-                   for i in range(n))
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=n))
 
 
 def fingerprint(s: str):
@@ -126,6 +357,13 @@ class StripeObject(object):
                 raise UserError(409, 'Conflict')
             store[key] = self
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        self._on_change(name)
+
+    def _on_change(self, name=None):
+        pass
+
     @classmethod
     def _get_class_for_id(cls, id):
         for child in cls.__subclasses__():
@@ -155,9 +393,11 @@ class StripeObject(object):
     @classmethod
     def _api_delete(cls, id):
         key = cls.object + ':' + id
-        if key not in store.keys():
+        obj = store.get(key)
+        if obj is None:
             raise UserError(404, 'Not Found')
         del store[key]
+        obj._on_change()
         return DeletedObject(id, cls.object)
 
     @classmethod
@@ -166,8 +406,7 @@ class StripeObject(object):
             raise UserError(400, 'Unexpected ' + ', '.join(kwargs.keys()))
 
         li = List(url, limit=limit, starting_after=starting_after)
-        li._list = [value for key, value in store.items()
-                    if key.startswith(cls.object + ':')]
+        li._list = store.of_type(cls.object)
         return li
 
     def _update(self, **data):
@@ -186,6 +425,14 @@ class StripeObject(object):
         for key, value in data.items():
             setattr(self, key, value)
 
+    @classmethod
+    def _public_class_attributes(cls):
+        # Cached because `dir()` is slow, and classes don't change:
+        if '_public_attributes' not in vars(cls):
+            cls._public_attributes = [
+                prop for prop in dir(cls) if not prop.startswith('_')]
+        return cls._public_attributes
+
     def _export(self, expand=None):
         try:
             if expand is None:
@@ -215,8 +462,8 @@ class StripeObject(object):
                     obj[key] = value
 
         # And add dynamic properties
-        for prop in dir(self):
-            if not prop.startswith('_') and prop not in obj:
+        for prop in self._public_class_attributes():
+            if prop not in obj:
                 value = getattr(self, prop)
                 if isinstance(value, StripeObject):
                     obj[prop] = value._export()
@@ -257,20 +504,9 @@ class Balance(object):
 
     def __init__(self):
         self.livemode = False
-        self.available = {
-            'amount': 2000,
-            'currency': 'eur',
-            'source_types': {
-                'card': 2000
-            }
-        }
-        self.pending = {
-            'amount': 0,
-            'currency': 'eur',
-            'source_types': {
-                'card': 0
-            }
-        }
+        # Running totals of balance transactions' net amounts, by status
+        # ('available' or 'pending'), then currency, then source type:
+        self._totals = None
 
         store[self.object] = self
 
@@ -283,17 +519,37 @@ class Balance(object):
             return cls()
         return obj
 
-    def _export(self, expand=None):
-        obj = {}
-
-        for key, value in vars(self).items():
-            if not key.startswith('_'):
-                if isinstance(value, dict):
-                    obj[key] = value.copy()
-                else:
-                    obj[key] = value
+    def _get_totals(self):
+        # Built from balance transactions the first time, then maintained by
+        # `BalanceTransaction.__init__()`:
+        totals = getattr(self, '_totals', None)
+        if totals is None:
+            self._totals = totals = {'available': {}, 'pending': {}}
+            for txn in store.of_type(BalanceTransaction.object):
+                self._record(txn)
+        return totals
+
+    def _record(self, txn):
+        status = 'available' if txn.status == 'available' else 'pending'
+        source_types = self._get_totals()[status].setdefault(txn.currency, {})
+        source_type = getattr(txn, '_source_type', 'card')
+        source_types[source_type] = source_types.get(source_type, 0) + txn.net
+
+    def _export_totals(self, status):
+        totals = self._get_totals()[status]
+        if not totals:
+            return [{'amount': 0, 'currency': 'eur',
+                     'source_types': {'card': 0}}]
+        return [{'amount': sum(source_types.values()),
+                 'currency': currency,
+                 'source_types': source_types.copy()}
+                for currency, source_types in sorted(totals.items())]
 
-        return obj
+    def _export(self, expand=None):
+        return {'object': self.object,
+                'livemode': self.livemode,
+                'available': self._export_totals('available'),
+                'pending': self._export_totals('pending')}
 
 
 extra_apis.append(('GET', '/v1/balance', Balance._api_retrieve))
@@ -305,7 +561,7 @@ class BalanceTransaction(StripeObject):
 
     def __init__(self, amount=None, currency=None, description=None,
                  exchange_rate=None, reporting_category=None, source=None,
-                 type=None, **kwargs):
+                 type=None, source_type=None, **kwargs):
         if kwargs:
             raise UserError(400, 'Unexpected ' + ', '.join(kwargs.keys()))
 
@@ -316,18 +572,28 @@ class BalanceTransaction(StripeObject):
             assert _type(currency) is str and currency
             assert description is None or _type(description) is str
             assert exchange_rate is None or _type(exchange_rate) is float
-            assert reporting_category in ('charge', 'refund')
+            assert reporting_category in ('charge', 'refund', 'payout',
+                                          'payout_reversal')
             assert _type(source) is str
-            assert type in ('charge', 'refund')
+            assert type in ('charge', 'refund', 'payout', 'payout_cancel',
+                            'payout_failure')
         except AssertionError:
             raise UserError(400, 'Bad request')
 
-        if source.startswith('ch_'):
-            Charge._api_retrieve(source)  # to return 404 if not existent
-        elif source.startswith('re_'):
-            Refund._api_retrieve(source)  # to return 404 if not existent
-        else:
+        if not source.startswith(('ch_', 're_', 'po_')):
             raise UserError(400, 'Bad request')
+        # The source type can be given by the caller, e.g. by a refund being
+        # created, which knows it before it is stored.
+        if source_type is None:
+            # to return 404 if not existent
+            if source.startswith('ch_'):
+                source_type = Charge._api_retrieve(source)._source_type()
+            elif source.startswith('re_'):
+                refund = Refund._api_retrieve(source)
+                source_type = \
+                    Charge._api_retrieve(refund.charge)._source_type()
+            else:
+                source_type = Payout._api_retrieve(source).source_type
 
         # All exceptions must be raised before this point
         super().__init__()
@@ -344,6 +610,15 @@ class BalanceTransaction(StripeObject):
         self.status = 'available'
         self.type = type
 
+        self._source_type = source_type
+
+        # (Unless totals are not built yet: they will include this
+        # transaction, which is already stored, when they are.)
+        balance = store.get(Balance.object)
+        if (balance is not None and
+                getattr(balance, '_totals', None) is not None):
+            balance._record(self)
+
     @property
     def net(self):
         return self.amount - self.fee
@@ -514,11 +789,30 @@ class Charge(StripeObject):
         self.failure_message = None
         self.captured = capture
         self.balance_transaction = None
+        # Saved because the payment method can be deleted before the charge
+        # is refunded, see `_source_type()`:
+        self._payment_source_type = \
+            'card' if source.type == 'card' else 'bank_account'
+
+        # Refunds of this charge, and their total amount (maintained by
+        # `Refund`):
+        self._refunds = []
+        self._amount_refunded = 0
 
     def _is_async_payment_method(self):
         pm = PaymentMethod._api_retrieve(self.payment_method)
         return pm.type == 'sepa_debit'
 
+    def _source_type(self):
+        source_type = getattr(self, '_payment_source_type', None)
+        if source_type is None:  # charge stored by an older version
+            try:
+                pm = PaymentMethod._api_retrieve(self.payment_method)
+            except UserError:  # deleted since
+                return 'card'
+            source_type = 'card' if pm.type == 'card' else 'bank_account'
+        return source_type
+
     def _trigger_payment(self, on_success=None):
         if self._is_async_payment_method():
             async def callback():
@@ -533,7 +827,7 @@ class Charge(StripeObject):
                 self.status = 'succeeded'
                 if on_success:
                     on_success()
-            asyncio.ensure_future(callback())
+            schedule(callback())
 
         else:
             txn = BalanceTransaction(amount=self.amount,
@@ -573,7 +867,7 @@ class Charge(StripeObject):
                     self._set_auth_failure()
                     if on_failure_later:
                         on_failure_later()
-                asyncio.ensure_future(callback())
+                schedule(callback())
             else:
                 self._set_auth_failure()
                 if on_failure_now:
@@ -625,14 +919,39 @@ class Charge(StripeObject):
     def paid(self):
         return self.status == 'succeeded'
 
+    def _get_refunds(self):
+        refunds = getattr(self, '_refunds', None)
+        if refunds is None:  # data stored by an older version
+            refunds = [r for r in store.of_type(Refund.object)
+                       if r.charge == self.id]
+            self._refunds = refunds
+            self._amount_refunded = sum(r.amount for r in refunds)
+        return refunds
+
+    def _list_refunds(self):
+        return sorted(self._get_refunds(), key=lambda r: r.date, reverse=True)
+
+    def _add_refund(self, refund):
+        self._get_refunds().append(refund)
+        self._amount_refunded += refund.amount
+
+    def _on_refund_change(self, refund):
+        refunds = self._get_refunds()
+        if refund in refunds and store.get(refund.object + ':' +
+                                           refund.id) is not refund:
+            refunds.remove(refund)  # deleted
+        self._amount_refunded = sum(r.amount for r in refunds)
+
     @property
     def refunds(self):
-        return Refund._api_list_all('/v1/charges/' + self.id + '/refunds',
-                                    charge=self.id)
+        li = List('/v1/charges/' + self.id + '/refunds')
+        li._list = self._list_refunds()
+        return li
 
     @property
     def amount_refunded(self):
-        return sum(refund.amount for refund in self.refunds._list)
+        self._get_refunds()
+        return self._amount_refunded
 
     @property
     def refunded(self):
@@ -720,6 +1039,9 @@ class Coupon(StripeObject):
         self.times_redeemed = 0
         self.valid = True
 
+    def _on_change(self, name=None):
+        preview_cache.invalidate()
+
 
 class Customer(StripeObject):
     object = 'customer'
@@ -811,8 +1133,27 @@ class Customer(StripeObject):
         self.tax_ids._list = [TaxId(customer=self.id, **data)
                               for data in tax_id_data]
 
+        # Invoice items not attached to an invoice yet, by ID (maintained by
+        # `InvoiceItem._index_pending()`):
+        self._pending_invoice_items = {}
+
         schedule_webhook(Event('customer.created', self))
 
+    def _on_change(self, name=None):
+        if 'id' in vars(self):
+            preview_cache.invalidate(self.id)
+
+    def _list_pending_invoice_items(self):
+        pending = getattr(self, '_pending_invoice_items', None)
+        if pending is None:  # data stored by an older version
+            pending = {ii.id: ii for ii in store.of_type(InvoiceItem.object)
+                       if ii.customer == self.id and ii.invoice is None}
+            self._pending_invoice_items = pending
+        items = [ii for ii in pending.values()
+                 if ii.invoice is None and ii.customer == self.id]
+        items.sort(key=lambda i: i.date, reverse=True)
+        return items
+
     def _get_default_payment_method_or_source(self):
         if self.invoice_settings.get('default_payment_method'):
             return PaymentMethod._api_retrieve(
@@ -856,7 +1197,9 @@ class Customer(StripeObject):
     def _api_delete(cls, id):
         obj = super()._api_retrieve(id)
         schedule_webhook(Event('customer.deleted', obj))
-        return super()._api_delete(id)
+        deleted = super()._api_delete(id)
+        preview_cache.forget(id)
+        return deleted
 
     @classmethod
     def _api_retrieve_source(cls, id, source_id, **kwargs):
@@ -1098,11 +1441,12 @@ class Event(StripeObject):
 
     def __init__(self, type, data):
         # All exceptions must be raised before this point.
-        super().__init__()
+        with span('webhooks'):
+            super().__init__()
 
-        self.type = type
-        self.data = {'object': data._export()}
-        self.api_version = '2017-08-15'
+            self.type = type
+            self.data = {'object': data._export()}
+            self.api_version = '2017-08-15'
 
     @classmethod
     def _api_create(cls, **data):
@@ -1244,11 +1588,9 @@ class Invoice(StripeObject):
             item.invoice = self.id
             self.lines._list.append(InvoiceLineItem(item))
 
-        pending_items = [ii for ii in InvoiceItem._api_list_all(
-            None, customer=self.customer, limit=99)._list
-            if ii.invoice is None]
+        pending_items = cus._list_pending_invoice_items()
         for ii in pending_items:
-            if not simulation:
+            if not simulation and not upcoming:
                 ii.invoice = self.id
             self.lines._list.append(InvoiceLineItem(ii))
 
@@ -1269,34 +1611,67 @@ class Invoice(StripeObject):
 
             schedule_webhook(Event('invoice.created', self))
 
+    def _on_change(self, name=None):
+        if name == '_totals':
+            return
+        if name in ('lines', 'tax_percent', 'default_tax_rates',
+                    'starting_balance'):
+            self._totals = None
+        if vars(self).get('customer') is not None:
+            preview_cache.invalidate(self.customer)
+
+    def _get_totals(self):
+        # Lines are only added at creation, so amounts are computed once and
+        # then reused by all properties, until taxes or balance change.
+        totals = getattr(self, '_totals', None)
+        if totals is not None:
+            return totals
+
+        subtotal = 0
+        tax_amounts = {}  # by tax rate ID, in order of appearance
+        for il in self.lines._list:
+            subtotal += il.amount
+            if il.tax_rates:
+                amounts = il.tax_amounts
+            elif self.default_tax_rates:
+                amounts = [tr._tax_amount(il.amount)
+                           for tr in self.default_tax_rates]
+            else:
+                amounts = []
+            for ta in amounts:
+                if ta['tax_rate'] in tax_amounts:
+                    tax_amounts[ta['tax_rate']]['amount'] += ta['amount']
+                else:
+                    tax_amounts[ta['tax_rate']] = ta
+
+        if self.tax_percent is not None:  # legacy support
+            tax = int(subtotal * self.tax_percent / 100.0)
+        else:
+            tax = sum(ta['amount'] for ta in tax_amounts.values())
+
+        self._totals = {
+            'subtotal': subtotal,
+            'tax': tax,
+            'total_tax_amounts': list(tax_amounts.values()),
+            'total': max(0, subtotal + tax - self.starting_balance),
+        }
+        return self._totals
+
     @property
     def subtotal(self):
-        return sum([il.amount for il in self.lines._list])
+        return self._get_totals()['subtotal']
 
     @property
     def tax(self):
-        if self.tax_percent is not None:  # legacy support
-            return int(self.subtotal * self.tax_percent / 100.0)
-
-        return sum([ta['amount'] for ta in self.total_tax_amounts])
+        return self._get_totals()['tax']
 
     @property
     def total_tax_amounts(self):
-        concat = []
-        for il in self.lines._list:
-            tax_amounts = []
-            if il.tax_rates:
-                tax_amounts = il.tax_amounts
-            elif self.default_tax_rates:
-                tax_amounts = [tr._tax_amount(il.amount)
-                               for tr in self.default_tax_rates]
-            concat.extend(tax_amounts)
-        # TODO: reduce `concat` by unique `tax_rate` ID
-        return concat
+        return [ta.copy() for ta in self._get_totals()['total_tax_amounts']]
 
     @property
     def total(self):
-        return max(0, self.subtotal + self.tax - self.starting_balance)
+        return self._get_totals()['total']
 
     @property
     def amount_due(self):
@@ -1434,9 +1809,7 @@ class Invoice(StripeObject):
                 [TaxRate._api_retrieve(tr)
                  for tr in subscription_default_tax_rates]
 
-        pending_items = [ii for ii in InvoiceItem._api_list_all(
-            None, customer=customer, limit=99)._list
-            if ii.invoice is None]
+        pending_items = customer_obj._list_pending_invoice_items()
         if (not upcoming and not subscription and
                 not subscription_items and not pending_items):
             raise UserError(400, 'Bad request')
@@ -1587,6 +1960,10 @@ class Invoice(StripeObject):
         return li
 
     @classmethod
+    @cached_preview(simulated_by=('subscription_items', 'subscription_prorate',
+                                  'subscription_tax_percent',
+                                  'subscription_default_tax_rates',
+                                  'subscription_trial_end'))
     def _api_upcoming_invoice(cls, customer=None, subscription=None,
                               coupon=None, subscription_items=None,
                               subscription_prorate=None,
@@ -1611,6 +1988,7 @@ class Invoice(StripeObject):
         return invoice
 
     @classmethod
+    @cached_preview(simulated_by=('subscription_details',))
     def _api_create_preview_invoice(cls, customer=None, subscription=None,
                                     subscription_details=None):
         try:
@@ -1780,6 +2158,25 @@ class InvoiceItem(StripeObject):
         self.tax_rates = tax_rates
         self.metadata = metadata or {}
 
+    def _on_change(self, name=None):
+        if name in (None, 'invoice', 'customer'):
+            self._index_pending()
+        if vars(self).get('customer') is not None:
+            preview_cache.invalidate(self.customer)
+
+    def _index_pending(self):
+        # Keep `Customer._pending_invoice_items` up to date. Customers stored
+        # by an older version have no index yet: it is built on first use.
+        cus = store.get('customer:%s' % vars(self).get('customer'))
+        pending = getattr(cus, '_pending_invoice_items', None)
+        if pending is None:
+            return
+        if (vars(self).get('invoice', False) is None and
+                store.get(self.object + ':' + self.id) is self):
+            pending[self.id] = self
+        else:
+            pending.pop(self.id, None)
+
     @classmethod
     def _api_list_all(cls, url, customer=None, limit=None,
                       starting_after=None):
@@ -1789,13 +2186,17 @@ class InvoiceItem(StripeObject):
         except AssertionError:
             raise UserError(400, 'Bad request')
 
+        if customer is not None:
+            li = List(url, limit=limit, starting_after=starting_after)
+            # to return 404 if not existant
+            li._list = Customer._api_retrieve(
+                customer)._list_pending_invoice_items()
+            return li
+
         li = super(InvoiceItem,
                    cls)._api_list_all(url, limit=limit,
                                       starting_after=starting_after)
         li._list = [ii for ii in li._list if ii.invoice is None]
-        if customer is not None:
-            Customer._api_retrieve(customer)  # to return 404 if not existant
-            li._list = [ii for ii in li._list if ii.customer == customer]
         li._list.sort(key=lambda i: i.date, reverse=True)
         return li
 
@@ -2418,11 +2819,16 @@ class Plan(StripeObject):
             else:
                 assert tiers_mode in ['graduated', 'volume']
                 assert type(tiers) is list and len(tiers) > 0
-                for t in tiers:
-                    assert \
-                        type(t) is dict and 'up_to' in t and \
-                        (t['up_to'] == 'inf' or
-                         type(try_convert_to_int(t['up_to'])) is int)
+                up_to = 0
+                for i, t in enumerate(tiers):
+                    assert type(t) is dict and 'up_to' in t
+                    # Only the last tier is unbounded, others are increasing:
+                    if i == len(tiers) - 1:
+                        assert t['up_to'] == 'inf'
+                    else:
+                        assert type(try_convert_to_int(t['up_to'])) is int
+                        assert int(t['up_to']) > up_to
+                        up_to = int(t['up_to'])
                     unit_amount = try_convert_to_int(t.get('unit_amount', 0))
                     assert type(unit_amount) is int and unit_amount >= 0
                     flat_amount = try_convert_to_int(t.get('flat_amount', 0))
@@ -2460,9 +2866,84 @@ class Plan(StripeObject):
         self.billing_scheme = billing_scheme
         self.tiers = tiers
         self.tiers_mode = tiers_mode
+        if billing_scheme == 'tiered':
+            self._get_tiers_table()
 
         schedule_webhook(Event('plan.created', self))
 
+    def _on_change(self, name=None):
+        if name == 'tiers':
+            self._tiers_table = None
+        if name != '_tiers_table':
+            preview_cache.invalidate()
+
+    def _get_tiers_table(self):
+        # Tiers are compiled once into typed arrays: upper bounds (the last
+        # tier is unbounded), unit and flat amounts, and the cumulative amount
+        # of all full tiers below each tier (for graduated pricing).
+        table = getattr(self, '_tiers_table', None)
+        if table is not None:
+            return table
+
+        bounds = array('q', (int(t['up_to']) for t in self.tiers[:-1]))
+        units = array('q', (int(t.get('unit_amount', 0)) for t in self.tiers))
+        flats = array('q', (int(t.get('flat_amount', 0)) for t in self.tiers))
+        cumulated = array('q', [0])
+        for i, up_to in enumerate(bounds):
+            lower = bounds[i - 1] if i > 0 else 0
+            cumulated.append(
+                cumulated[i] + (up_to - lower) * units[i] + flats[i])
+
+        self._tiers_table = (bounds, units, flats, cumulated)
+        return self._tiers_table
+
+    def _calculate_amount(self, quantity):
+        if self.billing_scheme == 'per_unit':
+            return self.amount * quantity
+
+        bounds, units, flats, cumulated = self._get_tiers_table()
+        # Index of the first tier whose `up_to` is >= quantity:
+        i = bisect_left(bounds, quantity)
+
+        if self.tiers_mode == 'volume':
+            return units[i] * quantity + flats[i]
+
+        if self.tiers_mode == 'graduated':
+            if quantity <= 0:
+                return 0
+            lower = bounds[i - 1] if i > 0 else 0
+            return cumulated[i] + (quantity - lower) * units[i] + flats[i]
+
+        return 0
+
+    def _calculate_amounts(self, quantities):
+        """Price many quantities at once, like `_calculate_amount()` for each
+        of them. Quantities are sorted, so that the tier table is walked once
+        instead of bisected for each quantity."""
+        quantities = list(quantities)
+        if self.billing_scheme == 'per_unit':
+            return [self.amount * quantity for quantity in quantities]
+
+        amounts = [0] * len(quantities)
+        if self.tiers_mode not in ('volume', 'graduated'):
+            return amounts
+
+        bounds, units, flats, cumulated = self._get_tiers_table()
+        i = 0
+        for j in sorted(range(len(quantities)), key=quantities.__getitem__):
+            quantity = quantities[j]
+            # Index of the first tier whose `up_to` is >= quantity:
+            while i < len(bounds) and bounds[i] < quantity:
+                i += 1
+
+            if self.tiers_mode == 'volume':
+                amounts[j] = units[i] * quantity + flats[i]
+            elif quantity > 0:
+                lower = bounds[i - 1] if i > 0 else 0
+                amounts[j] = (cumulated[i] + (quantity - lower) * units[i] +
+                              flats[i])
+        return amounts
+
     @property
     def name(self):  # Support Stripe API <= 2018-02-05
         return Product._api_retrieve(self.product).name
@@ -2546,8 +3027,6 @@ class Payout(StripeObject):
         # Payout scheduling is not implemented yet so all payouts are
         # manually created
         self.automatic = False
-        # Balance Transactions are no implemented yet so we fake one
-        self.balance_transaction = f'txn_{random_id(24)}'
 
         self.failure_balance_transaction = None
         self.failure_code = None
@@ -2557,16 +3036,31 @@ class Payout(StripeObject):
         self.status = status or 'pending'
         self.type = 'bank_account'
 
+        txn = BalanceTransaction(amount=-self.amount,
+                                 currency=self.currency,
+                                 description=self.description,
+                                 reporting_category='payout',
+                                 source=self.id, type='payout')
+        self.balance_transaction = txn.id
+
         schedule_webhook(Event('payout.created', self))
 
         if status == 'failed':
-            self.failure_balance_transaction = ''
+            self.failure_balance_transaction = \
+                self._reverse('payout_failure').id
             self.failure_code = 'could_not_process'
             self.failure_message = 'The bank could not process this payout.'
 
         if status in ('paid', 'failed'):
             schedule_webhook(Event(f'payout.{status}', self))
 
+    def _reverse(self, type):
+        return BalanceTransaction(amount=self.amount,
+                                  currency=self.currency,
+                                  description=self.description,
+                                  reporting_category='payout_reversal',
+                                  source=self.id, type=type)
+
     @classmethod
     def _api_update(cls, id, **data):
         obj = super()._api_update(id, **data)
@@ -2582,6 +3076,7 @@ class Payout(StripeObject):
             raise UserError(400, 'Cannot cancel payout')
 
         payout._update(status='canceled')
+        payout._reverse('payout_cancel')
 
         schedule_webhook(Event('payout.canceled', payout))
 
@@ -2643,6 +3138,9 @@ class Product(StripeObject):
 
         schedule_webhook(Event('product.created', self))
 
+    def _on_change(self, name=None):
+        preview_cache.invalidate()
+
     @classmethod
     def _api_list_all(cls, url, active=None, limit=None, starting_after=None,
                       **kwargs):
@@ -2700,6 +3198,7 @@ class Refund(StripeObject):
         charge_obj = Charge._api_retrieve(charge)
         if charge_obj.status == 'failed':
             raise UserError(400, 'Cannot refund a failed payment.')
+        source_type = charge_obj._source_type()
 
         # All exceptions must be raised before this point.
         super().__init__()
@@ -2721,9 +3220,18 @@ class Refund(StripeObject):
                                      description='REFUND FOR CHARGE',
                                      exchange_rate=1.0,
                                      reporting_category='refund',
-                                     source=self.id, type='refund')
+                                     source=self.id, type='refund',
+                                     source_type=source_type)
             self.balance_transaction = txn.id
 
+        charge_obj._add_refund(self)
+
+    def _on_change(self, name=None):
+        if name in (None, 'amount'):
+            charge = store.get('charge:%s' % vars(self).get('charge'))
+            if charge is not None:
+                charge._on_refund_change(self)
+
     @classmethod
     def _api_list_all(cls, url, charge=None, payment_intent=None, limit=None,
                       starting_after=None):
@@ -2740,11 +3248,14 @@ class Refund(StripeObject):
         except AssertionError:
             raise UserError(400, 'Bad request')
 
+        if charge is not None:
+            li = List(url, limit=limit, starting_after=starting_after)
+            # to return 404 if not existant
+            li._list = Charge._api_retrieve(charge)._list_refunds()
+            return li
+
         li = super(Refund, cls)._api_list_all(url, limit=limit,
                                               starting_after=starting_after)
-        if charge is not None:
-            Charge._api_retrieve(charge)  # to return 404 if not existant
-            li._list = [r for r in li._list if r.charge == charge]
         li._list.sort(key=lambda i: i.date, reverse=True)
         return li
 
@@ -3072,22 +3583,38 @@ class Subscription(StripeObject):
 
         schedule_webhook(Event('customer.subscription.created', self))
 
+    def _on_change(self, name=None):
+        if name == '_current_period':
+            return
+        if name in ('start_date', 'items'):
+            self._current_period = None
+        if vars(self).get('customer') is not None:
+            preview_cache.invalidate(self.customer)
+
     @property
     def plan(self):
         return self.items._list[0].plan
 
     @property
     def current_period_start(self):
-        return self.items._list[0]._current_period()['start']
+        return self._get_current_period()['start']
 
     @property
     def current_period_end(self):
-        return self.items._list[0]._current_period()['end']
+        return self._get_current_period()['end']
+
+    def _get_current_period(self):
+        # Computed once when the subscription starts, or when its start date
+        # or items change, instead of on each access:
+        period = getattr(self, '_current_period', None)
+        if period is None:
+            period = self.items._list[0]._period_from(self.start_date)
+            self._current_period = period
+        return period
 
     def _create_invoice(self):
-        pending_items = [ii for ii in InvoiceItem._api_list_all(
-            None, customer=self.customer, limit=99)._list
-            if ii.invoice is None]
+        pending_items = Customer._api_retrieve(
+            self.customer)._list_pending_invoice_items()
 
         for si in self.items._list:
             pending_items.append(si)
@@ -3365,13 +3892,25 @@ class SubscriptionItem(StripeObject):
 
         self._subscription = subscription
 
+    def _on_change(self, name=None):
+        sub = store.get('subscription:%s' % vars(self).get('_subscription'))
+        if sub is not None:
+            if name == 'plan':
+                sub._current_period = None
+            preview_cache.invalidate(sub.customer)
+
     def _current_period(self):
-        if self._subscription:
-            obj = Subscription._api_retrieve(self._subscription).start_date
-            start_date = obj
+        if not self._subscription:
+            return self._period_from(int(time.time()))
+
+        sub = Subscription._api_retrieve(self._subscription)
+        if self in sub.items._list:
+            period = sub._get_current_period()
         else:
-            start_date = int(time.time())
+            period = self._period_from(sub.start_date)
+        return period.copy()  # callers may modify it
 
+    def _period_from(self, start_date):
         end_date = datetime.fromtimestamp(start_date)
         if self.plan.interval == 'day':
             end_date += timedelta(days=1)
@@ -3385,44 +3924,7 @@ class SubscriptionItem(StripeObject):
         return dict(start=start_date, end=int(end_date.timestamp()))
 
     def _calculate_amount(self):
-        if self.plan.billing_scheme == 'per_unit':
-            return self.plan.amount * self.quantity
-
-        if self.plan.tiers_mode == 'volume':
-            index = next(
-                (i for i, t in enumerate(self.plan.tiers)
-                    if t['up_to'] == 'inf'
-                    or self.quantity <= int(t['up_to'])))
-            return self._calculate_amount_in_tier(
-                self.quantity, index)
-
-        if self.plan.tiers_mode == 'graduated':
-            quantity = self.quantity
-            amount = 0
-
-            tier_from = -1
-            for i, t in enumerate(self.plan.tiers):
-                tier_from += 1
-                if quantity <= 0 or tier_from > quantity:
-                    break
-
-                amount += self._calculate_amount_in_tier(
-                    quantity - tier_from, i)
-
-                if t['up_to'] == 'inf':
-                    quantity = 0
-                else:
-                    up_to = int(t['up_to'])
-                    quantity -= up_to
-                    tier_from = up_to
-
-            return amount
-
-        return 0
-
-    def _calculate_amount_in_tier(self, quantity, index):
-        t = self.plan.tiers[index]
-        return int(t['unit_amount']) * quantity + int(t['flat_amount'])
+        return self.plan._calculate_amount(self.quantity)
 
 
 class TaxId(StripeObject):
@@ -3511,6 +4013,9 @@ class TaxRate(StripeObject):
         self.jurisdiction = jurisdiction
         self.metadata = metadata or {}
 
+    def _on_change(self, name=None):
+        preview_cache.invalidate()
+
     def _tax_amount(self, amount):
         decimal = Decimal(str(amount * self.percentage / 100.0))
         return {'amount': int(decimal.quantize(Decimal('1.'), ROUND_HALF_UP)),
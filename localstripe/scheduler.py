@@ -0,0 +1,55 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+
+from .tenants import current_tenant
+
+
+# Background tasks (webhooks to send, asynchronous payments...) by tenant, kept
+# until they are done:
+_tasks = {}
+
+
+def schedule(coroutine):
+    tasks = _tasks.setdefault(current_tenant.get(), set())
+    task = asyncio.ensure_future(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+def pending_tasks():
+    return sum(len(tasks) for tasks in _tasks.values())
+
+
+async def wait_for_pending_tasks(timeout=None):
+    """Wait for the tasks of the current tenant, at most `timeout` seconds.
+    Returns whether they are all done."""
+    loop = asyncio.get_event_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    tasks = _tasks.get(current_tenant.get(), set())
+    # Tasks can schedule other tasks, e.g. a payment triggering a webhook:
+    while tasks:
+        remaining = None if deadline is None else deadline - loop.time()
+        if remaining is not None and remaining <= 0:
+            return False
+        await asyncio.wait(list(tasks), timeout=remaining)
+    return True
+
+
+def cancel_pending_tasks():
+    for task in list(_tasks.get(current_tenant.get(), ())):
+        task.cancel()
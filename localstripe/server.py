@@ -14,21 +14,45 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import asyncio
 import base64
+from contextlib import contextmanager
+import copy
 import json
 import logging
+import multiprocessing
+import operator
 import os.path
 import re
 import socket
+import sys
+import tempfile
+import time
 
+import aiohttp
 from aiohttp import web
 
 from .resources import BalanceTransaction, Charge, Coupon, Customer, Event, \
     Invoice, InvoiceItem, PaymentIntent, PaymentMethod, Payout, Plan, \
     Product, Refund, SetupIntent, Source, Subscription, SubscriptionItem, \
-    TaxRate, Token, extra_apis, store
+    TaxRate, Token, extra_apis, preview_cache, random_id, store, stores, \
+    try_convert_to_bool, try_convert_to_float, try_convert_to_int
 from .errors import UserError
-from .webhooks import register_webhook
+from . import generate
+from .idempotency import idempotency_cache
+from .memory import memory_stats, stop_tracemalloc, tracemalloc_diff
+from .metrics import Counter, Gauge, Histogram, export_metrics
+from .profiling import MAX_PROFILES, clear_profiles, get_profile, \
+    list_profiles, start_profile, stop_profile
+from .profiling import settings as profiling_settings
+from . import replay
+from .replay import RECORDED_HEADERS, Recorder
+from .scheduler import cancel_pending_tasks, pending_tasks, \
+    wait_for_pending_tasks
+from .tenants import current_tenant
+from .tracing import Trace, current_trace, span
+from .webhooks import hold_webhooks, register_webhook, restore_webhooks, \
+    save_webhooks
 
 
 def json_response(*args, **kwargs):
@@ -48,6 +72,38 @@ async def add_cors_headers(request, response):
             'GET, POST, OPTIONS, DELETE'
 
 
+def get_route(request):
+    # The route template (e.g. `/v1/customers/{id}`), or for API calls
+    # forwarded by workers, the one of the original request:
+    return request.get('original_route') or getattr(
+        request.match_info.route.resource, 'canonical', '(unmatched)')
+
+
+@web.middleware
+async def profiling_middleware(request, handler):
+    profile = None
+    if not request.path.startswith('/_config/profiling'):
+        forced = request.headers.get('Localstripe-Profile') in ('1', 'true')
+        profile = start_profile(forced)
+    if profile is None:
+        return await handler(request)
+
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        stop_profile(profile, request.get('original_method', request.method),
+                     request.get('original_path', request.path),
+                     get_route(request), status)
+    if not response.prepared:
+        response.headers['Localstripe-Profile-Id'] = profile.id
+    return response
+
+
 @web.middleware
 async def error_middleware(request, handler):
     try:
@@ -57,25 +113,30 @@ async def error_middleware(request, handler):
 
 
 async def get_post_data(request, remove_auth=True):
-    try:
-        data = await request.json()
-    except json.decoder.JSONDecodeError:
-        data = await request.post()
-        if data:
-            data = unflatten_data(data)
-
-    if data and remove_auth:
-        # Remove auth-related properties:
-        if 'key' in data:
-            del data['key']
-        if 'payment_user_agent' in data:
-            del data['payment_user_agent']
-        if 'referrer' in data:
-            del data['referrer']
+    with span('parse'):
+        try:
+            data = await request.json()
+        except json.decoder.JSONDecodeError:
+            data = await request.post()
+            if data:
+                data = unflatten_data(data)
+
+        if data and remove_auth:
+            remove_auth_params(data)
 
     return data
 
 
+def remove_auth_params(data):
+    # Remove auth-related properties:
+    if 'key' in data:
+        del data['key']
+    if 'payment_user_agent' in data:
+        del data['payment_user_agent']
+    if 'referrer' in data:
+        del data['referrer']
+
+
 # Try to decode values like
 #    curl -d card[cvc]=123 -d subscription_items[0][plan]=pro-yearly
 def unflatten_data(multidict):
@@ -136,7 +197,11 @@ def unflatten_data(multidict):
 
 
 def get_api_key(request):
-    header = request.headers.get('Authorization', '').split(' ')
+    return parse_authorization(request.headers.get('Authorization', ''))
+
+
+def parse_authorization(authorization):
+    header = authorization.split(' ')
     if len(header) != 2:
         return
 
@@ -150,8 +215,7 @@ def get_api_key(request):
         return api_key
 
 
-@web.middleware
-async def auth_middleware(request, handler):
+async def check_authentication(request):
     if request.path.startswith('/js.stripe.com/'):
         is_auth = True
 
@@ -187,103 +251,426 @@ async def auth_middleware(request, handler):
     if not is_auth:
         raise UserError(401, 'Unauthorized')
 
+
+@web.middleware
+async def auth_middleware(request, handler):
+    with span('auth'):
+        await check_authentication(request)
     return await handler(request)
 
 
+# Whether data is separate for each API key (it always is for each
+# `Stripe-Account` header, like for connected accounts on Stripe):
+isolate_tenants = False
+
+# Whether this process owns the data for worker processes (see `--workers`),
+# and only receives requests from them:
+is_state_owner = False
+
+
+async def get_tenant(request):
+    if is_state_owner:  # workers already found the tenant
+        return request.headers.get('Localstripe-Tenant', '')
+
+    account = request.headers.get('Stripe-Account')
+    if account:
+        return account
+
+    if not isolate_tenants:
+        return ''
+
+    api_key = get_api_key(request)
+    if api_key is None:
+        if request.method == 'POST':
+            data = await get_post_data(request, remove_auth=False)
+        else:
+            data = unflatten_data(request.query)
+        if (data and type(data.get('key')) is str and
+                data['key'].startswith('pk_')):
+            api_key = data['key']
+    if api_key is None:
+        return ''
+    # Drop the `sk_` or `pk_` prefix, so that a secret key and the public key
+    # with the same suffix work on the same data:
+    return api_key[3:]
+
+
+@web.middleware
+async def tenant_middleware(request, handler):
+    token = current_tenant.set(await get_tenant(request))
+    try:
+        return await handler(request)
+    finally:
+        current_tenant.reset(token)
+
+
 @web.middleware
 async def save_store_middleware(request, handler):
+    if (request.method not in ('PUT', 'POST', 'DELETE') or
+            # handled depending on the method of the original request:
+            request.path == '/_config/workers/api_call'):
+        return await handler(request)
+
+    # Only dump once, even if the request creates or updates many objects:
     try:
+        with store.deferred_dumps():
+            return await handler(request)
+    finally:
+        store.dump_to_disk()
+
+
+idempotent_requests = Counter(
+    'localstripe_idempotent_requests_total',
+    'Requests with an Idempotency-Key header, by result (new, replayed or '
+    'rejected).', ('result',))
+
+
+@web.middleware
+async def idempotency_middleware(request, handler):
+    key = request.headers.get('Idempotency-Key')
+    # Like on Stripe, only POST requests are idempotent. Workers forward the
+    # key of POST requests to the owner process (see `owner_headers()`):
+    if (key is None or request.method != 'POST' or
+            not (request.path.startswith('/v1/') or
+                 request.path == '/_config/workers/api_call')):
         return await handler(request)
+
+    # Keys of different accounts or API keys don't collide:
+    scope = (current_tenant.get(), get_api_key(request))
+    # (For forwarded requests, the body contains the original path and the
+    # decoded parameters.)
+    fingerprint = idempotency_cache.fingerprint(request.path_qs,
+                                                await request.read())
+    try:
+        cached = idempotency_cache.begin(scope, key, fingerprint)
+    except UserError:
+        idempotent_requests.inc('rejected')
+        raise
+    if cached is not None:
+        idempotent_requests.inc('replayed')
+        status, body, content_type = cached
+        return web.Response(status=status, body=body,
+                            content_type=content_type,
+                            headers={'Idempotent-Replayed': 'true'})
+
+    idempotent_requests.inc('new')
+    try:
+        response = await handler(request)
+    except UserError as e:
+        # Like on Stripe, errors are replayed too:
+        response = e.to_response()
+    except BaseException:
+        idempotency_cache.abort(scope, key)
+        raise
+    if (type(response) is web.Response and type(response.body) is bytes and
+            response.status < 500):
+        idempotency_cache.finish(scope, key, response.status, response.body,
+                                 response.content_type)
+    else:
+        idempotency_cache.abort(scope, key)
+    return response
+
+
+Gauge('localstripe_idempotency_cache_entries',
+      'Responses kept for requests with an Idempotency-Key header (for all '
+      'tenants).', lambda: len(idempotency_cache))
+
+
+# Whether to measure time spent in phases of requests (see `--trace`):
+trace_requests = False
+
+# Requests slower than this, and event loop lags longer than this, are logged
+# (in seconds, see `--slow-request-threshold`):
+slow_request_threshold = None
+
+slow_requests = Counter(
+    'localstripe_slow_requests_total',
+    'Requests slower than --slow-request-threshold, by route template.',
+    ('method', 'route'))
+
+
+@web.middleware
+async def tracing_middleware(request, handler):
+    # Like on Stripe, responses have a `Request-Id` header (see
+    # `add_tracing_headers()`). Workers give theirs to the owner process.
+    request['request_id'] = (
+        is_state_owner and request.headers.get('Localstripe-Request-Id') or
+        'req_' + random_id(14))
+    report = (trace_requests or
+              request.headers.get('Localstripe-Trace') in ('1', 'true'))
+    if not report and slow_request_threshold is None:
+        return await handler(request)
+
+    # Also trace requests when only slow ones are logged, to log their
+    # timings:
+    trace = Trace(request['request_id'])
+    token = current_trace.set(trace)
+    if report:
+        request['trace'] = trace
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
     finally:
-        if request.method in ('PUT', 'POST', 'DELETE'):
-            store.dump_to_disk()
+        current_trace.reset(token)
+        trace.finished = True
+        log_trace(request, trace, status, report)
+
+
+def log_trace(request, trace, status, report):
+    info = {'request_id': trace.request_id,
+            'method': request.get('original_method', request.method),
+            'route': get_route(request),
+            'status': status,
+            'timings': trace.timings()}
+    slow = (slow_request_threshold is not None and
+            trace.elapsed() > slow_request_threshold)
+    if slow:
+        slow_requests.inc(info['method'], info['route'])
+    if is_state_owner:  # workers log it, with their own timings
+        return
+
+    logger = logging.getLogger('aiohttp.access')
+    if slow:
+        params = json.dumps(request.get('params'), sort_keys=True,
+                            default=str)
+        if len(params) > 1000:
+            params = params[:1000] + '...'
+        logger.warning('slow request: %s, params: %s'
+                       % (json.dumps(info, sort_keys=True), params))
+    elif report:
+        logger.info(json.dumps(info, sort_keys=True))
+
+
+event_loop_lag = Histogram(
+    'localstripe_event_loop_lag_seconds',
+    'Delay of event loop timers, i.e. time during which the event loop was '
+    'blocked, and all requests waited.',
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
 
 
-app = web.Application(middlewares=[error_middleware, auth_middleware,
+async def monitor_event_loop(app, interval=0.1):
+    async def monitor():
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - start - interval, 0)
+            event_loop_lag.observe(lag)
+            if (slow_request_threshold is not None and
+                    lag > slow_request_threshold):
+                logging.getLogger('aiohttp.access').warning(
+                    'event loop blocked for %d ms' % (1000 * lag))
+
+    task = asyncio.ensure_future(monitor())
+    yield
+    task.cancel()
+
+
+async def add_tracing_headers(request, response):
+    if 'request_id' in request:
+        response.headers['Request-Id'] = request['request_id']
+    if 'trace' in request:
+        response.headers['Server-Timing'] = request['trace'].server_timing()
+
+
+# Where API requests are recorded (see `--record`):
+recorder = None
+
+
+@web.middleware
+async def record_middleware(request, handler):
+    if recorder is None or not request.path.startswith('/v1/'):
+        return await handler(request)
+
+    start_time, start = time.time(), time.perf_counter()
+    response = None
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        params = request.get('params')
+        headers = {name: request.headers[name] for name in RECORDED_HEADERS
+                   if name in request.headers}
+        if 'Authorization' not in headers and request.method == 'POST':
+            # Some requests are authenticated with a public key in data:
+            data = await get_post_data(request, remove_auth=False)
+            if data and 'key' in data:
+                params = dict(params or {}, key=data['key'])
+        body = None
+        if (status == 200 and isinstance(response, web.Response) and
+                response.content_type == 'application/json'):
+            body = response.body
+        recorder.record(start_time, request.method, request.path, params,
+                        headers, status, duration, body)
+
+
+request_duration = Histogram(
+    'localstripe_http_request_duration_seconds',
+    'Time spent handling HTTP requests, by route template.',
+    ('method', 'route', 'status'))
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        # The route template (e.g. `/v1/customers/{id}`), to keep the number
+        # of label values low:
+        request_duration.observe(time.perf_counter() - start,
+                                 request.get('original_method',
+                                             request.method),
+                                 get_route(request), status)
+
+
+app = web.Application(middlewares=[tracing_middleware, metrics_middleware,
+                                   record_middleware, profiling_middleware,
+                                   error_middleware, auth_middleware,
+                                   tenant_middleware, idempotency_middleware,
                                    save_store_middleware])
 app.on_response_prepare.append(add_cors_headers)
+app.on_response_prepare.append(add_tracing_headers)
+app.cleanup_ctx.append(monitor_event_loop)
+
+
+# API functions below take already decoded parameters and URL parts, and
+# return the JSON-serializable result. This way they can be called for HTTP
+# requests (see `http_handler()`) as well as for batch operations (see
+# `config_batch()`).
+
+def export(obj, expand=None):
+    with span('export'):
+        return obj._export(expand=expand)
 
 
 def api_create(cls, url):
-    async def f(request):
-        data = await get_post_data(request)
-        data = data or {}
+    def f(data, match_info):
         expand = data.pop('expand', None)
-        return json_response(cls._api_create(**data)._export(expand=expand))
+        return export(cls._api_create(**data), expand=expand)
     return f
 
 
 def api_retrieve(cls, url):
-    def f(request):
-        id = request.match_info['id']
-        data = unflatten_data(request.query)
+    def f(data, match_info):
         expand = data.pop('expand', None)
-        return json_response(cls._api_retrieve(id)._export(expand=expand))
+        return export(cls._api_retrieve(match_info['id']), expand=expand)
     return f
 
 
 def api_update(cls, url):
-    async def f(request):
-        id = request.match_info['id']
-        data = await get_post_data(request)
+    def f(data, match_info):
         if not data:
             raise UserError(400, 'Bad request')
         expand = data.pop('expand', None)
-        return json_response(cls._api_update(id, **data)._export(
-            expand=expand))
+        return export(cls._api_update(match_info['id'], **data),
+                      expand=expand)
     return f
 
 
 def api_delete(cls, url):
-    def f(request):
-        id = request.match_info['id']
-        return json_response(cls._api_delete(id)._export())
+    def f(data, match_info):
+        return export(cls._api_delete(match_info['id']))
     return f
 
 
 def api_list_all(cls, url):
-    def f(request):
-        data = unflatten_data(request.query)
+    def f(data, match_info):
         expand = data.pop('expand', None)
-        return json_response(cls._api_list_all(url, **data)
-                             ._export(expand=expand))
+        return export(cls._api_list_all(url, **data), expand=expand)
     return f
 
 
 def api_extra(func, url):
-    async def f(request):
-        data = await get_post_data(request) or {}
-        data.update(unflatten_data(request.query) or {})
-        if 'id' in request.match_info:
-            data['id'] = request.match_info['id']
-        if 'source_id' in request.match_info:
-            data['source_id'] = request.match_info['source_id']
-        if 'subscription_id' in request.match_info:
-            data['subscription_id'] = request.match_info['subscription_id']
-        if 'tax_id' in request.match_info:
-            data['tax_id'] = request.match_info['tax_id']
+    def f(data, match_info):
+        data.update(match_info)
         expand = data.pop('expand', None)
-        return json_response(func(**data)._export(expand=expand))
+        return export(func(**data), expand=expand)
     return f
 
 
+async def get_request_data(request, from_body, from_query):
+    data = {}
+    if from_body:
+        data = await get_post_data(request) or {}
+    if from_query:
+        with span('parse'):
+            data.update(unflatten_data(request.query) or {})
+    # For logs of slow requests and recordings (before the API function
+    # modifies it, including nested items):
+    request['params'] = copy.deepcopy(data)
+    return data
+
+
+def http_handler(func, from_body, from_query):
+    async def f(request):
+        data = await get_request_data(request, from_body, from_query)
+        with span('logic'):
+            result = func(data, dict(request.match_info))
+        with span('json'):
+            return json_response(result)
+    return f
+
+
+# List of `(method, url, regex, func, from_body, from_query)`, in the same
+# order as in the router:
+api_routes = []
+
+
+def add_api_route(method, url, func, from_body=False, from_query=False):
+    app.router.add_route(method, url,
+                         http_handler(func, from_body, from_query))
+    regex = re.sub(r'\\\{(\w+)\\\}', r'(?P<\1>[^/]+)', re.escape(url))
+    api_routes.append((method, url, re.compile('^' + regex + '$'), func,
+                       from_body, from_query))
+
+
+def resolve_api_route(method, path):
+    for route_method, url, regex, func, from_body, from_query in api_routes:
+        if route_method == method:
+            match = regex.match(path)
+            if match:
+                return func, match.groupdict()
+    raise UserError(404, 'Not Found')
+
+
 # Extra routes must be added *before* regular routes, because otherwise
 # `/invoices/upcoming` would fall into `/invoices/{id}`.
 for method, url, func in extra_apis:
-    app.router.add_route(method, url, api_extra(func, url))
+    add_api_route(method, url, api_extra(func, url),
+                  from_body=True, from_query=True)
 
 
 for cls in (BalanceTransaction, Charge, Coupon, Customer, Event, Invoice,
             InvoiceItem, PaymentIntent, PaymentMethod, Payout, Plan, Product,
             Refund, SetupIntent, Source, Subscription, SubscriptionItem,
             TaxRate, Token):
-    for method, url, func in (
-            ('POST', '/v1/' + cls.object + 's', api_create),
-            ('GET', '/v1/' + cls.object + 's/{id}', api_retrieve),
-            ('POST', '/v1/' + cls.object + 's/{id}', api_update),
-            ('DELETE', '/v1/' + cls.object + 's/{id}', api_delete),
-            ('GET', '/v1/' + cls.object + 's', api_list_all)):
-        app.router.add_route(method, url, func(cls, url))
+    for method, url, func, from_body, from_query in (
+            ('POST', '/v1/' + cls.object + 's', api_create, True, False),
+            ('GET', '/v1/' + cls.object + 's/{id}', api_retrieve,
+             False, True),
+            ('POST', '/v1/' + cls.object + 's/{id}', api_update, True, False),
+            ('DELETE', '/v1/' + cls.object + 's/{id}', api_delete,
+             False, False),
+            ('GET', '/v1/' + cls.object + 's', api_list_all, False, True)):
+        add_api_route(method, url, func(cls, url), from_body, from_query)
 
 
 def localstripe_js(request):
@@ -312,32 +699,648 @@ async def config_webhook(request):
 
 async def flush_store(request):
     store.clear()
+    idempotency_cache.clear(current_tenant.get())
+    return web.Response()
+
+
+def resolve_references(value, results):
+    # Replace `${name:field}` by the value of `field` in the result of the
+    # operation named `name`, like in Stripe CLI fixtures.
+    if type(value) is dict:
+        return {k: resolve_references(v, results) for k, v in value.items()}
+    elif type(value) is list:
+        return [resolve_references(v, results) for v in value]
+    elif type(value) is str and '${' in value:
+        def replace(match):
+            try:
+                return str(results[match.group(1)][match.group(2)])
+            except KeyError:
+                raise UserError(400, 'Unknown reference ' + match.group(0))
+        return re.sub(r'\$\{(\w+):(\w+)\}', replace, value)
+    return value
+
+
+def run_batch_operation(operation, results):
+    if type(operation) is not dict:
+        raise UserError(400, 'Bad request')
+    method = operation.get('method', None)
+    path = operation.get('path', None)
+    params = operation.get('params', None) or {}
+    name = operation.get('name', None)
+    if (type(method) is not str or type(path) is not str or
+            type(params) is not dict or
+            (name is not None and type(name) is not str)):
+        raise UserError(400, 'Bad request')
+
+    path = resolve_references(path, results)
+    params = resolve_references(params, results)
+    func, match_info = resolve_api_route(method.upper(), path)
+    remove_auth_params(params)
+    result = func(params, match_info)
+    if name is not None:
+        results[name] = result
+    return result
+
+
+@contextmanager
+def store_transaction(send_webhooks=True):
+    """Roll back all changes made to the store within this context if an
+    exception is raised. Webhooks are only sent once the context exits
+    successfully (and if `send_webhooks` is true)."""
+    # Objects are modified in place, so keep a full copy to roll back to:
+    backup = store.snapshot()
+    with hold_webhooks() as events:
+        try:
+            yield
+        except BaseException:
+            events.clear()
+            store.restore(backup)
+            raise
+        if not send_webhooks:
+            events.clear()
+
+
+async def config_batch(request):
+    # Unlike `request.json()`, reading the stream is not limited to
+    # `client_max_size` (1 MiB), so large batches are possible:
+    try:
+        data = json.loads(await request.content.read() or b'{}')
+    except ValueError:
+        raise UserError(400, 'Bad request')
+    if type(data) is not dict:
+        raise UserError(400, 'Bad request')
+    operations = data.get('operations', None)
+    atomic = data.get('atomic', False)
+    if type(operations) is not list:
+        raise UserError(400, 'Bad request')
+    if atomic not in (True, False, 'true', 'false'):
+        raise UserError(400, 'Bad request')
+    atomic = atomic in (True, 'true')
+
+    responses = []
+    results = {}
+    with store_transaction() if atomic else hold_webhooks():
+        for i, operation in enumerate(operations):
+            try:
+                body = run_batch_operation(operation, results)
+                responses.append({'status': 200, 'body': body})
+            except UserError as e:
+                if atomic:
+                    e.body['error']['operation'] = i
+                    raise
+                responses.append({'status': e.code, 'body': e.body})
+
+    return json_response(responses)
+
+
+def import_objects(lines):
+    """Run create operations read from newline-delimited JSON, in one
+    transaction and without sending webhooks. Each line is an operation like
+    for `/_config/batch`, where `method` defaults to POST.
+
+    Returns the number of operations."""
+    count = 0
+    results = {}
+    with store_transaction(send_webhooks=False):
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                operation = json.loads(line)
+            except ValueError:
+                raise UserError(400, 'Bad request', {'line': number})
+            if type(operation) is dict:
+                operation.setdefault('method', 'POST')
+            try:
+                run_batch_operation(operation, results)
+            except UserError as e:
+                e.body['error']['line'] = number
+                raise
+            count += 1
+    return count
+
+
+async def read_lines(stream):
+    """Split a request body into lines as it streams in. Unlike
+    `request.text()`, this is not limited to `client_max_size` (1 MiB)."""
+    lines = []
+    rest = b''
+    async for chunk in stream.iter_any():
+        *complete, rest = (rest + chunk).split(b'\n')
+        lines.extend(complete)
+    lines.append(rest)
+    return lines
+
+
+async def config_import(request):
+    # Read the whole body before importing, so that other requests cannot run
+    # in the middle of the transaction:
+    lines = await read_lines(request.content)
+    count = import_objects(lines)
+    return json_response({'imported': count})
+
+
+async def config_export(request):
+    data = unflatten_data(request.query)
+    types = data.pop('type', None)
+    created = data.pop('created', None)
+    bounds = []
+    try:
+        assert not data  # no other params are supported
+        if types is not None:
+            if type(types) is str:
+                types = [types]
+            assert type(types) is list
+            assert all(type(t) is str for t in types)
+        if created is not None:
+            assert type(created) is dict
+            for op in ('gt', 'gte', 'lt', 'lte'):
+                if op in created:
+                    value = try_convert_to_int(created.pop(op))
+                    assert type(value) is int
+                    bounds.append((getattr(operator, op), value))
+            assert not created  # no other params are supported
+    except AssertionError:
+        raise UserError(400, 'Bad request')
+
+    # Only take references to the objects (not their exports), so that memory
+    # use doesn't depend on the size of the data:
+    if types is not None:
+        objects = [obj for t in types for obj in store.of_type(t)]
+    else:
+        objects = list(store.values())
+
+    response = web.StreamResponse(
+        headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+
+    chunk = []
+    chunk_size = 0
+    for obj in objects:
+        if bounds:
+            date = getattr(obj, 'created', None)
+            if date is None or not all(compare(date, value)
+                                       for compare, value in bounds):
+                continue
+        try:
+            line = json.dumps(obj._export(), sort_keys=True) + '\n'
+        except UserError:
+            # Objects can be modified by other requests while streaming, and
+            # it's too late to return an error.
+            logging.getLogger('aiohttp.access').warning(
+                'cannot export %s %s' % (obj.object, getattr(obj, 'id', '')))
+            continue
+        chunk.append(line)
+        chunk_size += len(line)
+        if chunk_size >= 65536:
+            await response.write(''.join(chunk).encode('utf-8'))
+            chunk = []
+            chunk_size = 0
+    await response.write(''.join(chunk).encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+# Saved states of the store and webhooks, by tenant and name:
+snapshots = {}
+# How long saving a snapshot waits for scheduled work, in seconds:
+SNAPSHOT_WAIT_TIMEOUT = 5
+
+
+async def create_snapshot(request):
+    name = request.match_info['name']
+    # Let scheduled work (payments, webhooks...) finish, so that it is part of
+    # the snapshot instead of being lost, unless it takes too long (e.g. a
+    # webhook endpoint that doesn't respond):
+    if not await wait_for_pending_tasks(timeout=SNAPSHOT_WAIT_TIMEOUT):
+        logging.getLogger('aiohttp.access').warning(
+            'snapshot saved before scheduled work was done')
+    snapshots[(current_tenant.get(), name)] = (store.snapshot(),
+                                               save_webhooks())
+    return web.Response()
+
+
+async def restore_snapshot(request):
+    key = (current_tenant.get(), request.match_info['name'])
+    if key not in snapshots:
+        raise UserError(404, 'Not Found')
+    # Work scheduled since the snapshot must not affect the restored state:
+    cancel_pending_tasks()
+    saved_store, saved_webhooks = snapshots[key]
+    store.restore(saved_store)
+    restore_webhooks(saved_webhooks)
+    # Responses to later requests refer to objects that don't exist anymore:
+    idempotency_cache.clear(current_tenant.get())
+    return web.Response()
+
+
+async def delete_snapshot(request):
+    key = (current_tenant.get(), request.match_info['name'])
+    if snapshots.pop(key, None) is None:
+        raise UserError(404, 'Not Found')
+    return web.Response()
+
+
+def tenants_stats(request):
+    return json_response({
+        tenant: {type: len(objects)
+                 for type, objects in tenant_store._by_type.items()
+                 if objects}
+        for tenant, tenant_store in stores.items()})
+
+
+def get_memory_stats(request):
+    limit = try_convert_to_int(request.query.get('limit', 10))
+    trace = try_convert_to_bool(request.query.get('tracemalloc', None))
+    try:
+        assert type(limit) is int and limit > 0
+        assert trace is None or type(trace) is bool
+    except AssertionError:
+        raise UserError(400, 'Bad request')
+
+    stats = memory_stats(stores, limit)
+    if trace:
+        stats['tracemalloc'] = tracemalloc_diff(limit)
+    elif trace is False:
+        stop_tracemalloc()
+    return json_response(stats)
+
+
+def preview_cache_stats(request):
+    return json_response(preview_cache.stats())
+
+
+def count_objects():
+    counts = {}
+    for tenant_store in list(stores.values()):
+        for type, objects in tenant_store._by_type.items():
+            counts[(type,)] = counts.get((type,), 0) + len(objects)
+    return counts
+
+
+Gauge('localstripe_objects', 'Stored objects, by type (for all tenants).',
+      count_objects, ('type',))
+Gauge('localstripe_scheduled_tasks',
+      'Background tasks (webhooks, asynchronous payments...) not done yet.',
+      pending_tasks)
+
+
+def profiling_status():
+    return dict(profiling_settings, max_profiles=MAX_PROFILES,
+                profiles=list_profiles())
+
+
+def get_profiling(request):
+    return json_response(profiling_status())
+
+
+async def configure_profiling(request):
+    data = await get_post_data(request) or {}
+    enabled = try_convert_to_bool(data.get('enabled', True))
+    sample_rate = try_convert_to_float(
+        data.get('sample_rate', profiling_settings['sample_rate']))
+    try:
+        assert type(enabled) is bool
+        assert type(sample_rate) is float
+        assert 0 <= sample_rate <= 1
+    except AssertionError:
+        raise UserError(400, 'Bad request')
+    profiling_settings.update(enabled=enabled, sample_rate=sample_rate)
+    return json_response(profiling_status())
+
+
+async def delete_profiles(request):
+    profiling_settings['enabled'] = False
+    clear_profiles()
     return web.Response()
 
 
+def download_profile(request):
+    profile = get_profile(request.match_info['id'])
+    if profile is None:
+        raise UserError(404, 'Not Found')
+    format = request.query.get('format', 'text')
+    if format == 'text':
+        return web.Response(text=profile.to_text())
+    elif format == 'collapsed':
+        return web.Response(text=profile.to_collapsed())
+    elif format == 'pstats':
+        return web.Response(
+            body=profile.to_pstats(),
+            content_type='application/octet-stream',
+            headers={'Content-Disposition':
+                     'attachment; filename="%s.pstats"' % profile.id})
+    raise UserError(400, 'Bad request')
+
+
+def config_metrics(request):
+    return web.Response(
+        body=export_metrics().encode('utf-8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
 app.router.add_post('/_config/webhooks/{id}', config_webhook)
 app.router.add_delete('/_config/data', flush_store)
+app.router.add_post('/_config/batch', config_batch)
+app.router.add_post('/_config/import', config_import)
+app.router.add_get('/_config/export', config_export)
+app.router.add_post('/_config/snapshots/{name}', create_snapshot)
+app.router.add_post('/_config/snapshots/{name}/restore', restore_snapshot)
+app.router.add_delete('/_config/snapshots/{name}', delete_snapshot)
+app.router.add_get('/_config/stats/invoice_previews', preview_cache_stats)
+app.router.add_get('/_config/stats/tenants', tenants_stats)
+app.router.add_get('/_config/stats/memory', get_memory_stats)
+app.router.add_get('/_config/metrics', config_metrics)
+app.router.add_get('/_config/profiling', get_profiling)
+app.router.add_post('/_config/profiling', configure_profiling)
+app.router.add_delete('/_config/profiling', delete_profiles)
+app.router.add_get('/_config/profiling/{id}', download_profile)
+
+
+# With `--workers`, worker processes handle HTTP connections, authentication,
+# decoding of parameters and encoding of responses. They pass decoded API calls
+# to the process that owns the data (which runs them like batch operations),
+# and proxy other requests to it.
+
+# In worker processes, connection to the process that owns the data:
+owner_session = None
+
+
+async def run_forwarded_api_call(request):
+    # Calls are plain JSON, so that nothing in them is executed:
+    try:
+        call = json.loads(await request.read())
+        method, path, route, data = (call['method'], call['path'],
+                                     call['route'], call['data'])
+        assert type(data) is dict
+    except (ValueError, KeyError, TypeError, AssertionError):
+        raise UserError(400, 'Bad request')
+    # Count and profile it like the original request:
+    request['original_method'] = method
+    request['original_path'] = path
+    request['original_route'] = route
+    func, match_info = resolve_api_route(method, path)
+    if method in ('PUT', 'POST', 'DELETE'):
+        try:
+            with store.deferred_dumps(), span('logic'):
+                result = func(data, match_info)
+        finally:
+            store.dump_to_disk()
+    else:
+        with span('logic'):
+            result = func(data, match_info)
+    # Compact JSON is quick to encode, workers indent it (see
+    # `forward_api_call()`):
+    with span('json'):
+        body = json.dumps(result).encode('utf-8')
+    return web.Response(body=body, content_type='application/json')
+
+
+def owner_headers(request):
+    headers = {'Localstripe-Tenant': current_tenant.get(),
+               'Localstripe-Request-Id': request['request_id']}
+    if current_trace.get() is not None:
+        headers['Localstripe-Trace'] = 'true'
+    if 'Localstripe-Profile' in request.headers:
+        headers['Localstripe-Profile'] = request.headers['Localstripe-Profile']
+    if request.method == 'POST' and 'Idempotency-Key' in request.headers:
+        # The owner process keeps responses, by API key (see
+        # `idempotency_middleware()`):
+        for name in ('Idempotency-Key', 'Authorization'):
+            if name in request.headers:
+                headers[name] = request.headers[name]
+    return headers
+
+
+def relay_headers(owner_response, response):
+    if 'Localstripe-Profile-Id' in owner_response.headers:
+        response.headers['Localstripe-Profile-Id'] = \
+            owner_response.headers['Localstripe-Profile-Id']
+    if 'Idempotent-Replayed' in owner_response.headers:
+        response.headers['Idempotent-Replayed'] = \
+            owner_response.headers['Idempotent-Replayed']
+    # Time spent in the owner process is part of the `forward` span:
+    trace = current_trace.get()
+    if trace is not None and 'Server-Timing' in owner_response.headers:
+        trace.add_timings(owner_response.headers['Server-Timing'], 'forward')
+
+
+def forward_api_call(from_body, from_query):
+    async def f(request):
+        data = await get_request_data(request, from_body, from_query)
+        with span('forward'):
+            # (Keys are sorted, so that retried calls have the same
+            # fingerprint in `idempotency_middleware()`.)
+            call = json.dumps({
+                'method': request.method, 'path': request.path,
+                'route': request.match_info.route.resource.canonical,
+                'data': data}, sort_keys=True)
+            async with owner_session.post(
+                    'http://owner/_config/workers/api_call',
+                    data=call.encode('utf-8'),
+                    headers=owner_headers(request)) as r:
+                body = await r.read()
+        if r.status != 200:  # an error, already encoded as JSON
+            response = web.Response(status=r.status, body=body,
+                                    content_type=r.content_type)
+        else:
+            with span('json'):
+                response = json_response(json.loads(body))
+        relay_headers(r, response)
+        return response
+    return f
+
+
+async def refuse_owner_request(request):
+    # Routes of the owner process for workers are only reachable through its
+    # private socket:
+    raise UserError(404, 'Not Found')
+
+
+async def forward_request(request):
+    headers = dict(request.headers)
+    headers.update(owner_headers(request))
+    # The body is streamed to the owner (it can be larger than
+    # `client_max_size`, e.g. for `/_config/import`), chunked if needed:
+    headers.pop('Transfer-Encoding', None)
+    with span('forward'):
+        r = await owner_session.request(
+            request.method, 'http://owner' + request.path_qs,
+            headers=headers, data=request.content)
+    async with r:
+        response = web.StreamResponse(status=r.status)
+        if 'Content-Type' in r.headers:
+            response.headers['Content-Type'] = r.headers['Content-Type']
+        relay_headers(r, response)
+        await response.prepare(request)
+        async for chunk in r.content.iter_chunked(65536):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+
+def create_worker_app(owner_path):
+    worker_app = web.Application(middlewares=[tracing_middleware,
+                                              record_middleware,
+                                              error_middleware,
+                                              auth_middleware,
+                                              tenant_middleware])
+    worker_app.on_response_prepare.append(add_cors_headers)
+    worker_app.on_response_prepare.append(add_tracing_headers)
+
+    async def connect_to_owner(worker_app):
+        global owner_session
+        owner_session = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=owner_path))
+
+    async def disconnect_from_owner(worker_app):
+        await owner_session.close()
+
+    worker_app.on_startup.append(connect_to_owner)
+    worker_app.on_cleanup.append(disconnect_from_owner)
+
+    for method, url, _, _, from_body, from_query in api_routes:
+        worker_app.router.add_route(method, url,
+                                    forward_api_call(from_body, from_query))
+    worker_app.router.add_route('*', '/_config/workers/{path:.*}',
+                                refuse_owner_request)
+    worker_app.router.add_route('*', '/{path:.*}', forward_request)
+    return worker_app
+
+
+def run_worker(port, owner_path, isolate, trace, slow_threshold,
+               record_path):
+    # (Globals may have been inherited from the owner process, when forked.)
+    global is_state_owner, isolate_tenants, trace_requests, \
+        slow_request_threshold, recorder
+    is_state_owner = False
+    isolate_tenants = isolate
+    trace_requests = trace
+    slow_request_threshold = slow_threshold
+    # Workers record requests, not the owner:
+    recorder = Recorder(record_path) if record_path else None
+
+    # All workers listen on the same port, the kernel balances connections:
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('::', port))
+
+    logger = logging.getLogger('aiohttp.access')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler())
+
+    web.run_app(create_worker_app(owner_path), sock=sock, access_log=logger,
+                print=None)
 
 
 def start():
+    if sys.argv[1:2] == ['generate']:
+        return generate.main(sys.argv[2:])
+    if sys.argv[1:2] == ['replay']:
+        return replay.main(sys.argv[2:])
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('--port', type=int, default=8420)
+    parser.add_argument('--port', type=int,
+                        help='TCP port to listen on (default: 8420, unless '
+                             '--unix-socket is given)')
+    parser.add_argument('--unix-socket', metavar='PATH',
+                        help='listen on this unix socket (in addition to '
+                             'TCP, if --port is given)')
     parser.add_argument('--from-scratch', action='store_true')
+    parser.add_argument('--isolate-tenants', action='store_true',
+                        help='keep data separate for each API key (without '
+                             'its sk_ or pk_ prefix), like it is for each '
+                             'Stripe-Account header')
+    parser.add_argument('--seed', metavar='FILE',
+                        help='import objects from a newline-delimited JSON '
+                             'file, see /_config/import')
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help='handle HTTP requests in N processes, in front '
+                             'of the one that owns the data')
+    parser.add_argument('--trace', action='store_true',
+                        help='measure time spent in phases of requests, and '
+                             'report it in Server-Timing headers and logs')
+    parser.add_argument('--slow-request-threshold', type=float, metavar='MS',
+                        help='log requests slower than this, with their '
+                             'parameters and timings, and event loop lags '
+                             'longer than this')
+    parser.add_argument('--record', metavar='FILE',
+                        help='append API requests to this file, to replay '
+                             'them with `localstripe replay FILE`')
     args = parser.parse_args()
 
-    if not args.from_scratch:
-        store.try_load_from_disk()
+    if args.workers < 0:
+        parser.error('--workers must be positive')
+    if args.slow_request_threshold is not None and \
+            args.slow_request_threshold < 0:
+        parser.error('--slow-request-threshold must be positive')
+    if args.workers and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers is not supported on this system')
+    if args.workers and args.unix_socket:
+        parser.error('--workers cannot be used with --unix-socket')
+    if args.port is None and args.unix_socket is None:
+        args.port = 8420
+
+    global isolate_tenants, trace_requests, slow_request_threshold, recorder
+    isolate_tenants = args.isolate_tenants
+    trace_requests = args.trace
+    if args.record and not args.workers:
+        recorder = Recorder(args.record)
+    if args.slow_request_threshold is not None:
+        slow_request_threshold = args.slow_request_threshold / 1000
+
+    # Stores are loaded from disk when first used:
+    stores.load_from_disk = not args.from_scratch
+
+    if args.seed:
+        # Import once the event loop runs, because creating some objects
+        # schedules asynchronous tasks.
+        async def seed(app):
+            try:
+                with store.deferred_dumps(), open(args.seed) as f:
+                    count = import_objects(f)
+            except UserError as e:
+                raise SystemExit('cannot import %s: %s'
+                                 % (args.seed, json.dumps(e.body['error'])))
+            store.dump_to_disk()
+            logging.getLogger('aiohttp.access').info(
+                'imported %d objects from %s' % (count, args.seed))
+        app.on_startup.append(seed)
+
+    if args.workers:
+        # Only workers can reach this process, through a private socket. It is
+        # listening before workers start, so that they can forward requests
+        # right away.
+        global is_state_owner
+        is_state_owner = True
+        app.router.add_post('/_config/workers/api_call',
+                            run_forwarded_api_call)
+        owner_path = os.path.join(tempfile.mkdtemp(), 'owner.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(owner_path)
+        sock.listen(128)
+        for i in range(args.workers):
+            multiprocessing.Process(
+                target=run_worker, daemon=True,
+                args=(args.port, owner_path, args.isolate_tenants,
+                      args.trace, slow_request_threshold,
+                      args.record)).start()
+
+    elif args.port is not None:
+        # Listen on both IPv4 and IPv6
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('::', args.port))
 
-    # Listen on both IPv4 and IPv6
-    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('::', args.port))
+    else:
+        sock = None
 
     logger = logging.getLogger('aiohttp.access')
     logger.setLevel(logging.DEBUG)
     logger.addHandler(logging.StreamHandler())
 
-    web.run_app(app, sock=sock, access_log=logger)
+    web.run_app(app, sock=sock, path=args.unix_socket, access_log=logger)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,23 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextvars
+
+
+# Tenant that the current request works for, set by the server for each
+# request (see `server.tenant_middleware()`). Data, webhooks and scheduled
+# tasks are separate for each tenant. Background tasks inherit the tenant of
+# the request that scheduled them.
+current_tenant = contextvars.ContextVar('current_tenant', default='')
@@ -0,0 +1,83 @@
+# Copyright 2026 Adrien Vergé
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+import contextvars
+import time
+
+
+# Trace of the current request, when requests are traced (see `--trace`):
+current_trace = contextvars.ContextVar('current_trace', default=None)
+# Time spent in spans within the current span, so that each span only counts
+# its own time:
+_children_time = contextvars.ContextVar('children_time', default=None)
+
+
+class Trace(object):
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.finished = False
+        # Own time by span name, in seconds:
+        self.spans = {}
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def timings(self):
+        """Return own time of spans and total time, in milliseconds."""
+        # (Timings added from other processes were rounded, hence `max()`.)
+        timings = {name: round(1000 * max(duration, 0), 3)
+                   for name, duration in self.spans.items()}
+        timings['total'] = round(1000 * self.elapsed(), 3)
+        return timings
+
+    def add_timings(self, server_timing, parent):
+        """Add spans measured by another process (as given in its
+        `Server-Timing` header) within the `parent` span."""
+        for entry in server_timing.split(','):
+            name, _, duration = entry.strip().partition(';dur=')
+            if name != 'total' and duration:
+                duration = float(duration) / 1000
+                self.spans[name] = self.spans.get(name, 0) + duration
+                self.spans[parent] = self.spans.get(parent, 0) - duration
+
+    def server_timing(self):
+        return ', '.join('%s;dur=%s' % (name, duration)
+                         for name, duration in self.timings().items())
+
+
+@contextmanager
+def span(name):
+    """Count the time spent within this context in the `name` span of the
+    current trace, if any. Spans of the same name add up."""
+    trace = current_trace.get()
+    # Tasks scheduled by a request can outlive it:
+    if trace is None or trace.finished:
+        yield
+        return
+
+    parent = _children_time.get()
+    children = [0]
+    token = _children_time.set(children)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _children_time.reset(token)
+        trace.spans[name] = trace.spans.get(name, 0) + elapsed - children[0]
+        if parent is not None:
+            parent[0] += elapsed
@@ -14,15 +14,36 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+from contextlib import contextmanager
 import hashlib
 import hmac
 import json
 import logging
+import time
+from urllib.parse import unquote
 
 import aiohttp
 
+from .metrics import Counter, Gauge, Histogram
+from .scheduler import schedule
+from .tenants import current_tenant
+from .tracing import span
 
+
+# Registered webhooks by tenant, then by ID:
 _webhooks = {}
+_held_events = None
+# Events scheduled to be sent, and not sent yet:
+_queued_events = 0
+
+Gauge('localstripe_webhook_queue_depth',
+      'Webhook events scheduled to be sent, and not sent yet.',
+      lambda: _queued_events)
+delivery_duration = Histogram(
+    'localstripe_webhook_delivery_duration_seconds',
+    'Time spent delivering webhooks to their endpoint.')
+deliveries = Counter('localstripe_webhook_deliveries_total',
+                     'Webhook deliveries, by result.', ('result',))
 
 
 class Webhook(object):
@@ -33,40 +54,102 @@ class Webhook(object):
 
 
 def register_webhook(id, url, secret, events):
-    _webhooks[id] = Webhook(url, secret, events)
+    webhooks = _webhooks.setdefault(current_tenant.get(), {})
+    webhooks[id] = Webhook(url, secret, events)
 
 
-async def _send_webhook(event):
+def save_webhooks():
+    return dict(_webhooks.get(current_tenant.get(), {}))
+
+
+def restore_webhooks(saved):
+    _webhooks[current_tenant.get()] = dict(saved)
+
+
+def _encode_payload(event):
     payload = json.dumps(event._export(), indent=2, sort_keys=True)
-    payload = payload.encode('utf-8')
-    signed_payload = b'%d.%s' % (event.created, payload)
+    return payload.encode('utf-8')
+
+
+def _signature_header(secret, timestamp, payload):
+    signature = hmac.new(secret.encode('utf-8'),
+                         b'%d.%s' % (timestamp, payload),
+                         hashlib.sha256).hexdigest()
+    return 't=%d,v1=%s' % (timestamp, signature)
+
+
+def _endpoints(event):
+    webhooks = _webhooks.get(current_tenant.get(), {}).values()
+    return [webhook for webhook in webhooks
+            if webhook.events is None or event.type in webhook.events]
+
+
+async def _send_webhook(event):
+    payload = _encode_payload(event)
 
     await asyncio.sleep(1)
 
     logger = logging.getLogger('aiohttp.access')
 
-    for webhook in _webhooks.values():
-        if webhook.events is not None and event.type not in webhook.events:
-            continue
-
-        signature = hmac.new(webhook.secret.encode('utf-8'),
-                             signed_payload, hashlib.sha256).hexdigest()
+    for webhook in _endpoints(event):
         headers = {
             'Content-Type': 'application/json; charset=utf-8',
-            'Stripe-Signature': 't=%d,v1=%s' % (event.created, signature)}
-        async with aiohttp.ClientSession() as session:
+            'Stripe-Signature': _signature_header(webhook.secret,
+                                                  event.created, payload)}
+        url, connector = webhook.url, None
+        # Receivers listening on a unix socket are given like
+        # `http+unix://%2Fpath%2Fto%2Fsocket/api/url`:
+        if url.startswith('http+unix://'):
+            socket_path, _, path = url[len('http+unix://'):].partition('/')
+            url = 'http://localhost/' + path
+            connector = aiohttp.UnixConnector(path=unquote(socket_path))
+        start = time.perf_counter()
+        async with aiohttp.ClientSession(connector=connector) as session:
             try:
-                async with session.post(webhook.url,
+                async with session.post(url,
                                         data=payload, headers=headers) as r:
                     if r.status >= 200 and r.status < 300:
                         logger.info('webhook "%s" successfully delivered'
                                     % event.type)
+                        deliveries.inc('success')
                     else:
                         logger.info('webhook "%s" failed with response code %d'
                                     % (event.type, r.status))
+                        deliveries.inc('http_error')
             except aiohttp.client_exceptions.ClientError as e:
                 logger.info('webhook "%s" failed: %s' % (event.type, e))
+                deliveries.inc('connection_error')
+        delivery_duration.observe(time.perf_counter() - start)
 
 
 def schedule_webhook(event):
-    asyncio.ensure_future(_send_webhook(event))
+    global _queued_events
+    if _held_events is not None:
+        _held_events.append(event)
+    # Nothing to wait for (e.g. before saving a snapshot) if no endpoint
+    # listens to this event:
+    elif _endpoints(event):
+        with span('webhooks'):
+            _queued_events += 1
+            schedule(_send_webhook(event)).add_done_callback(
+                _on_webhook_done)
+
+
+def _on_webhook_done(task):
+    global _queued_events
+    _queued_events -= 1
+
+
+@contextmanager
+def hold_webhooks():
+    """Don't send webhooks for events scheduled within this context, until it
+    exits. Events removed from the yielded list are not sent at all."""
+    global _held_events
+    previous, _held_events = _held_events, []
+    events = _held_events
+    try:
+        yield events
+    finally:
+        _held_events = previous
+        for event in events:
+            schedule_webhook(event)
@@ -508,6 +508,32 @@ curl -sSfg -u $SK: $HOST/v1/invoices/create_preview \
      -d subscription_details[items][0][plan]=basique-annuel \
      -d subscription_details[proration_date]=1504182686
 
+# upcoming invoices are cached until the customer's billing state changes
+# (and, when they are dated from the current time, until the second ends)
+upcoming="$HOST/v1/invoices/upcoming?customer=$cus&subscription=$sub"
+hits=$(curl -sSfg $HOST/_config/stats/invoice_previews \
+       | grep -oP '"hits": \K([0-9]+)')
+total=$(curl -sSfg -u $SK: "$upcoming" | grep -oP '"total": \K([0-9]+)')
+sleep 1
+curl -sSfg -u $SK: "$upcoming"
+newhits=$(curl -sSfg $HOST/_config/stats/invoice_previews \
+          | grep -oP '"hits": \K([0-9]+)')
+[ "$newhits" -eq $((hits + 1)) ]
+curl -sSfg -u $SK: $HOST/v1/coupons -d id=PREVIEW10 -d percent_off=10 \
+     -d duration=once
+curl -sSfg -u $SK: "$upcoming"
+[ "$(curl -sSfg $HOST/_config/stats/invoice_previews \
+     | grep -oP '"hits": \K([0-9]+)')" -eq "$newhits" ]
+curl -sSfg -u $SK: -X DELETE $HOST/v1/coupons/PREVIEW10
+ii=$(curl -sSfg -u $SK: $HOST/v1/invoiceitems \
+          -d customer=$cus -d amount=1000 -d currency=eur \
+     | grep -oE 'ii_\w+' | head -n 1)
+newtotal=$(curl -sSfg -u $SK: "$upcoming" | grep -oP '"total": \K([0-9]+)')
+[ "$newtotal" -eq $((total + 1000)) ]
+curl -sSfg -u $SK: -X DELETE $HOST/v1/invoiceitems/$ii
+newtotal=$(curl -sSfg -u $SK: "$upcoming" | grep -oP '"total": \K([0-9]+)')
+[ "$newtotal" -eq "$total" ]
+
 curl -sSfg -u $SK: $HOST/v1/invoices/$in/lines
 
 cus=$(curl -sSfg -u $SK: $HOST/v1/customers \
@@ -523,7 +549,9 @@ curl -sSfg -u $SK: $HOST/v1/subscriptions \
       -d items[0][plan]=annual-tiered-volume \
       -d items[0][quantity]=5
 
-curl -sSfg -u $SK: $HOST/v1/invoices?customer=$cus
+# all 5 units are priced at the second tier: 5 * 1000 + 1200
+curl -sSfg -u $SK: $HOST/v1/invoices?customer=$cus \
+  | grep -q '"total": 6200,'
 
 curl -sSfg -u $SK: $HOST/v1/subscriptions?customer=$cus
 
@@ -543,6 +571,61 @@ sub=$(curl -sSfg -u $SK: $HOST/v1/subscriptions \
            -d items[0][quantity]=5 \
       | grep -oE 'sub_\w+' | head -n 1)
 
+# 1 * 500 + 1000 for the first tier, 4 * 1000 + 1200 for the second one
+curl -sSfg -u $SK: $HOST/v1/invoices?customer=$cus \
+  | grep -q '"total": 6700,'
+
+curl -sSfg -u $SK: $HOST/v1/plans \
+   -d id=monthly-3-tiers-graduated \
+   -d name='Monthly graduated with 3 tiers' \
+   -d currency=eur \
+   -d interval=month \
+   -d billing_scheme=tiered \
+   -d tiers_mode=graduated \
+   -d tiers[0][up_to]=5 \
+   -d tiers[0][unit_amount]=100 \
+   -d tiers[0][flat_amount]=7 \
+   -d tiers[1][up_to]=10 \
+   -d tiers[1][unit_amount]=50 \
+   -d tiers[2][up_to]=inf \
+   -d tiers[2][unit_amount]=10 \
+   -d tiers[2][flat_amount]=3
+
+# tiers must have increasing bounds, and the last one must be unbounded
+code=$(curl -sg -o /dev/null -w "%{http_code}" -u $SK: $HOST/v1/plans \
+            -d name='Bad tiers' -d currency=eur -d interval=month \
+            -d billing_scheme=tiered -d tiers_mode=volume \
+            -d tiers[0][up_to]=10 -d tiers[1][up_to]=5)
+[ "$code" = 400 ]
+
+# 5 * 100 + 7, then 5 * 50, then 2 * 10 + 3
+curl -sSfg -u $SK: $HOST/v1/invoices/upcoming?customer=$cus\&subscription_items[0][plan]=monthly-3-tiers-graduated\&subscription_items[0][quantity]=12 \
+  | grep -q '"subtotal": 780,'
+
+# many quantities can be priced at once, like one by one
+python - <<'PYTHON'
+import random
+
+from localstripe.embedded import Client
+from localstripe.resources import Plan
+from localstripe.tenants import current_tenant
+
+with Client() as client:
+    current_tenant.set(client.tenant)
+    product = client.request('POST', '/v1/products', {'name': 'Tiers'})
+    quantities = [random.randint(0, 40) for _ in range(200)] + [0, 5, 10]
+    for mode in ('volume', 'graduated'):
+        plan = Plan._api_retrieve(client.request('POST', '/v1/plans', {
+            'product': product['id'], 'currency': 'eur',
+            'interval': 'month', 'billing_scheme': 'tiered',
+            'tiers_mode': mode, 'tiers': [
+                {'up_to': 5, 'unit_amount': 100, 'flat_amount': 7},
+                {'up_to': 10, 'unit_amount': 50},
+                {'up_to': 'inf', 'unit_amount': 10, 'flat_amount': 3}]})['id'])
+        assert plan._calculate_amounts(quantities) == \
+            [plan._calculate_amount(q) for q in quantities], mode
+PYTHON
+
 data=$(curl -sSfg -u $SK: $HOST/v1/subscriptions/$sub \
             -d items[0][plan]=annual-tiered-volume)
 
@@ -1286,6 +1369,9 @@ curl -sSfg -u $SK: $HOST/v1/invoiceitems \
      -d description="One time discount" \
      -d tax_rates[]=$txr3
 
+curl -sSfg -u $SK: $HOST/v1/invoiceitems?customer=$cus \
+  | grep -q '"total_count": 1,'
+
 inv=$(curl -sSfg -u $SK: $HOST/v1/subscriptions \
            -d customer=$cus \
            -d items[0][plan]=basique-annuel \
@@ -1295,3 +1381,501 @@ inv=$(curl -sSfg -u $SK: $HOST/v1/subscriptions \
 total=$(curl -sSfg -u $SK: $HOST/v1/invoices/$inv \
         | grep -oP '"total": \K([0-9]+)' )
 [ "$total" -eq 16383 ]
+
+# both lines use the same tax rate, so they are summed in total_tax_amounts
+# (the 2 other occurrences are the lines' own tax_amounts)
+count=$(curl -sSfg -u $SK: $HOST/v1/invoices/$inv \
+        | grep -c "\"tax_rate\": \"$txr3\"")
+[ "$count" -eq 3 ]
+
+# the pending invoice item is now attached to the subscription's invoice
+curl -sSfg -u $SK: $HOST/v1/invoiceitems?customer=$cus \
+  | grep -q '"total_count": 0,'
+
+# the billing period follows the plan interval when the plan changes
+cus=$(curl -sSfg -u $SK: $HOST/v1/customers \
+           -d email=period@example.com \
+      | grep -oE 'cus_\w+' | head -n 1)
+curl -sSfg -u $SK: $HOST/v1/customers/$cus/sources \
+     -d source[object]=card \
+     -d source[number]=4242424242424242 \
+     -d source[exp_month]=12 \
+     -d source[exp_year]=2030 \
+     -d source[cvc]=123
+sub=$(curl -sSfg -u $SK: $HOST/v1/subscriptions \
+           -d customer=$cus \
+           -d items[0][plan]=basique-mensuel)
+sub_id=$(echo "$sub" | grep -oE 'sub_\w+' | head -n 1)
+start=$(echo "$sub" | grep -oP '"current_period_start": \K([0-9]+)' | head -n 1)
+end=$(echo "$sub" | grep -oP '"current_period_end": \K([0-9]+)' | head -n 1)
+[ $((end - start)) -le $((31 * 24 * 3600)) ]
+end=$(curl -sSfg -u $SK: $HOST/v1/subscriptions/$sub_id \
+           -d items[0][plan]=basique-annuel \
+      | grep -oP '"current_period_end": \K([0-9]+)' | head -n 1)
+[ $((end - start)) -ge $((365 * 24 * 3600)) ]
+
+# partial refunds add up on the charge
+charge=$(curl -sSfg -u $SK: $HOST/v1/charges \
+              -d customer=$cus \
+              -d amount=1000 \
+              -d currency=eur \
+         | grep -oE 'ch_\w+' | head -n 1)
+curl -sSfg -u $SK: $HOST/v1/refunds -d charge=$charge -d amount=300
+curl -sSfg -u $SK: $HOST/v1/refunds -d charge=$charge -d amount=200
+res=$(curl -sSfg -u $SK: $HOST/v1/charges/$charge)
+grep -q '"amount_refunded": 500,' <<<"$res"
+grep -q '"refunded": false,' <<<"$res"
+curl -sSfg -u $SK: $HOST/v1/refunds?charge=$charge \
+  | grep -q '"total_count": 2,'
+
+# the balance follows balance transactions (charges, refunds and payouts)
+eur_available() {
+  curl -sSfg -u $SK: $HOST/v1/balance | tr -d ' \n' \
+    | grep -oP '\{"amount":\K-?[0-9]+(?=,"currency":"eur")' | head -n 1
+}
+before=$(eur_available)
+curl -sSfg -u $SK: $HOST/v1/charges \
+     -d customer=$cus -d amount=1000 -d currency=eur
+[ "$(eur_available)" -eq $((before + 1000)) ]
+payout=$(curl -sSfg -u $SK: $HOST/v1/payouts -d amount=300 -d currency=eur \
+         | grep -oE 'po_\w+' | head -n 1)
+[ "$(eur_available)" -eq $((before + 700)) ]
+curl -sSfg -u $SK: $HOST/v1/payouts/$payout/cancel -X POST
+[ "$(eur_available)" -eq $((before + 1000)) ]
+
+# charges can be refunded after their card is deleted
+tok=$(curl -sSfg -u $SK: $HOST/v1/tokens \
+           -d card[number]=4242424242424242 \
+           -d card[exp_month]=12 \
+           -d card[exp_year]=2030 \
+           -d card[cvc]=123 \
+      | grep -oE 'tok_\w+' | head -n 1)
+cus=$(curl -sSfg -u $SK: $HOST/v1/customers -d source=$tok \
+      | grep -oE 'cus_\w+' | head -n 1)
+res=$(curl -sSfg -u $SK: $HOST/v1/charges \
+           -d customer=$cus -d amount=1000 -d currency=eur)
+charge=$(grep -oE 'ch_\w+' <<<"$res" | head -n 1)
+card=$(grep -oP '"payment_method": "\K(card_\w+)' <<<"$res")
+curl -sSfg -u $SK: -X DELETE $HOST/v1/customers/$cus/sources/$card
+before=$(eur_available)
+curl -sSfg -u $SK: $HOST/v1/refunds -d charge=$charge
+[ "$(eur_available)" -eq $((before - 1000)) ]
+
+# batch operations run in order, and can be all-or-nothing
+res=$(curl -sSf -u $SK: $HOST/_config/batch \
+           -H 'Content-Type: application/json' -d '{"operations": [
+             {"method": "POST", "path": "/v1/customers",
+              "params": {"email": "batch@example.com"}},
+             {"method": "GET", "path": "/v1/customers",
+              "params": {"email": "batch@example.com"}},
+             {"method": "GET", "path": "/v1/customers/cus_doesnotexist"}]}')
+grep -q '"status": 200$' <<<"$res"
+grep -q '"status": 404$' <<<"$res"
+grep -q '"total_count": 1,' <<<"$res"
+code=$(curl -s -o /dev/null -w '%{http_code}' -u $SK: $HOST/_config/batch \
+            -H 'Content-Type: application/json' -d '{"atomic": true,
+              "operations": [
+                {"method": "POST", "path": "/v1/customers",
+                 "params": {"email": "batch@example.com"}},
+                {"method": "POST", "path": "/v1/customers/cus_doesnotexist",
+                 "params": {"description": "fails"}}]}')
+[ "$code" = 404 ]
+curl -sSfg -u $SK: $HOST/v1/customers?email=batch@example.com \
+  | grep -q '"total_count": 1,'
+
+# import objects from newline-delimited JSON, in one transaction
+res=$(curl -sSf $HOST/_config/import --data-binary @- <<'NDJSON'
+{"name": "cus", "path": "/v1/customers", "params": {"email": "import@example.com"}}
+
+{"path": "/v1/invoiceitems", "params": {"customer": "${cus:id}", "amount": 700, "currency": "eur"}}
+NDJSON
+)
+grep -q '"imported": 2' <<<"$res"
+cus=$(curl -sSfg -u $SK: $HOST/v1/customers?email=import@example.com \
+      | grep -oE 'cus_\w+' | head -n 1)
+curl -sSfg -u $SK: "$HOST/v1/invoiceitems?customer=$cus" \
+  | grep -q '"amount": 700,'
+code=$(curl -s -o /dev/null -w '%{http_code}' $HOST/_config/import \
+            --data-binary @- <<'NDJSON'
+{"path": "/v1/customers", "params": {"email": "import2@example.com"}}
+{"path": "/v1/invoiceitems", "params": {"customer": "cus_doesnotexist"}}
+NDJSON
+)
+[ "$code" = 400 ]
+curl -sSfg -u $SK: $HOST/v1/customers?email=import2@example.com \
+  | grep -q '"total_count": 0,'
+
+# imports and batches can be larger than aiohttp's default 1 MiB limit
+res=$(python -c '
+import json
+for i in range(40):
+    print(json.dumps({"path": "/v1/customers",
+                      "params": {"email": "bigimport@example.com",
+                                 "description": "x" * 30000}}))' \
+      | curl -sSf $HOST/_config/import --data-binary @-)
+grep -q '"imported": 40' <<<"$res"
+res=$(python -c '
+import json
+print(json.dumps({"operations": [
+    {"method": "POST", "path": "/v1/customers",
+     "params": {"email": "bigbatch@example.com",
+                "description": "x" * 30000}}] * 40}))' \
+      | curl -sSf -u $SK: $HOST/_config/batch \
+             -H 'Content-Type: application/json' --data-binary @-)
+[ "$(grep -c '"status": 200$' <<<"$res")" -eq 40 ]
+
+# export objects as newline-delimited JSON
+count=$(curl -sSfg -u $SK: $HOST/v1/tax_rates \
+        | grep -oP '"total_count": \K([0-9]+)')
+[ "$(curl -sSfg "$HOST/_config/export?type=tax_rate" | wc -l)" -eq "$count" ]
+curl -sSfg "$HOST/_config/export?type[]=customer&type[]=plan" \
+  | grep -q '"email": "import@example.com"'
+[ "$(curl -sSfg "$HOST/_config/export?created[gt]=$(date -d +1day +%s)" \
+     | wc -l)" -eq 0 ]
+code=$(curl -sg -o /dev/null -w '%{http_code}' \
+            "$HOST/_config/export?created[after]=1")
+[ "$code" = 400 ]
+
+# snapshots of the store can be restored
+curl -sSf -X POST $HOST/_config/snapshots/before
+count=$(curl -sSfg -u $SK: $HOST/v1/customers \
+        | grep -oP '"total_count": \K([0-9]+)' | tail -n 1)
+curl -sSfg -u $SK: $HOST/v1/customers -d email=snapshot@example.com
+curl -sSf -X POST $HOST/_config/snapshots/before/restore
+[ "$(curl -sSfg -u $SK: $HOST/v1/customers \
+     | grep -oP '"total_count": \K([0-9]+)' | tail -n 1)" -eq "$count" ]
+curl -sSfg -u $SK: $HOST/v1/customers?email=snapshot@example.com \
+  | grep -q '"total_count": 0,'
+curl -sSf -X DELETE $HOST/_config/snapshots/before
+code=$(curl -s -o /dev/null -w '%{http_code}' -X POST \
+            $HOST/_config/snapshots/before/restore)
+[ "$code" = 404 ]
+
+# saving a snapshot doesn't wait for webhooks if no endpoint listens to them,
+# and doesn't wait forever for endpoints that don't respond
+curl -sSfg -u $SK: -H 'Stripe-Account: acct_snapshot' $HOST/v1/customers \
+     -d email=snapshot@example.com
+time=$(curl -sSf -o /dev/null -w '%{time_total}' -X POST \
+            -H 'Stripe-Account: acct_snapshot' $HOST/_config/snapshots/quick)
+python -c "assert $time < 0.5"
+python -c '
+import socket, time
+s = socket.socket()
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+s.bind(("localhost", 8424))
+s.listen()
+time.sleep(60)' &
+hang=$!
+curl -sSf -H 'Stripe-Account: acct_snapshot' $HOST/_config/webhooks/hang \
+     -d secret=whsec_hang -d url=http://localhost:8424/
+curl -sSfg -u $SK: -H 'Stripe-Account: acct_snapshot' $HOST/v1/customers \
+     -d email=snapshot@example.com
+time=$(curl -sSf -o /dev/null -w '%{time_total}' -X POST \
+            -H 'Stripe-Account: acct_snapshot' $HOST/_config/snapshots/slow)
+python -c "assert 4 < $time < 8"
+kill $hang
+curl -sSf -X DELETE -H 'Stripe-Account: acct_snapshot' $HOST/_config/data
+
+# data is separate for each Stripe-Account header (or each API key, with
+# --isolate-tenants)
+curl -sSfg -u $SK: -H 'Stripe-Account: acct_tenant1' $HOST/v1/customers \
+     -d email=tenant1@example.com
+curl -sSfg -u $SK: -H 'Stripe-Account: acct_tenant1' \
+     $HOST/v1/customers?email=tenant1@example.com \
+  | grep -q '"total_count": 1,'
+curl -sSfg -u $SK: $HOST/v1/customers?email=tenant1@example.com \
+  | grep -q '"total_count": 0,'
+curl -sSfg $HOST/_config/stats/tenants | tr -d ' \n' \
+  | grep -q '"acct_tenant1":{"customer":1,'
+curl -sSf -X DELETE -H 'Stripe-Account: acct_tenant1' $HOST/_config/data
+curl -sSfg -u $SK: -H 'Stripe-Account: acct_tenant1' $HOST/v1/customers \
+  | grep -q '"total_count": 0,'
+curl -sSfg -u $SK: $HOST/v1/customers?email=import@example.com \
+  | grep -q '"total_count": 1,'
+
+# embedded mode, without HTTP and on separate data
+python - <<'PYTHON'
+from localstripe.embedded import Client
+from localstripe.errors import UserError
+
+with Client() as client:
+    cus = client.request('POST', '/v1/customers', {'email': 'e@example.com'})
+    res = client.request('GET', '/v1/customers', {'email': 'e@example.com'})
+    assert [c['id'] for c in res['data']] == [cus['id']]
+    try:
+        client.request('GET', '/v1/customers/cus_doesnotexist')
+        assert False
+    except UserError as e:
+        assert e.code == 404
+    body, status, _ = client.handle_http_request(
+        'get', 'http://localhost/v1/customers/' + cus['id'],
+        {'Authorization': 'Bearer sk_test_12345'})
+    assert status == 200 and cus['id'] in body
+    with Client() as other:
+        assert other.request('GET', '/v1/customers')['data'] == []
+PYTHON
+
+# upcoming invoices are cached separately for each tenant, even when they
+# hold objects with the same IDs
+python - <<'PYTHON'
+import random
+
+from localstripe.embedded import Client
+
+card = {'number': '4242424242424242', 'exp_month': 12, 'exp_year': 2030,
+        'cvc': '123'}
+with Client() as a, Client() as b:
+    for client in (a, b):
+        random.seed('same IDs')
+        product = client.request('POST', '/v1/products', {'name': 'P'})
+        plan = client.request('POST', '/v1/plans', {
+            'product': product['id'], 'amount': 1000, 'currency': 'eur',
+            'interval': 'month'})
+        token = client.request('POST', '/v1/tokens', {'card': card})
+        cus = client.request('POST', '/v1/customers', {'source': token['id']})
+        client.request('POST', '/v1/subscriptions', {
+            'customer': cus['id'], 'items': [{'plan': plan['id']}]})
+    b.request('POST', '/v1/invoiceitems', {
+        'customer': cus['id'], 'amount': 500, 'currency': 'eur'})
+    upcoming = {'customer': cus['id']}
+    total_a = a.request('GET', '/v1/invoices/upcoming', upcoming)['total']
+    total_b = b.request('GET', '/v1/invoices/upcoming', upcoming)['total']
+    assert total_b == total_a + 500, (total_a, total_b)
+PYTHON
+
+# metrics, in the Prometheus text format
+metrics=$(curl -sSf $HOST/_config/metrics)
+echo "$metrics" | grep -q \
+  '^localstripe_http_request_duration_seconds_count{method="POST",route="/v1/customers",status="200"} [1-9]'
+echo "$metrics" | grep -q \
+  '^localstripe_http_request_duration_seconds_bucket{method="GET",route="/v1/customers/{id}",status="200",le="+Inf"} [1-9]'
+echo "$metrics" | grep -q '^localstripe_objects{type="customer"} [1-9]'
+echo "$metrics" | grep -q '^localstripe_store_dump_duration_seconds_count [1-9]'
+echo "$metrics" | grep -q '^localstripe_scheduled_tasks [0-9]'
+echo "$metrics" | grep -q '^localstripe_webhook_queue_depth [0-9]'
+
+# profile a request on demand, and download the profile
+profile=$(curl -sSf -u $SK: -H 'Localstripe-Profile: true' -D - -o /dev/null \
+               $HOST/v1/customers -d email=profiled@example.com \
+            | grep -i '^Localstripe-Profile-Id:' | cut -d' ' -f2 | tr -d '\r')
+[ -n "$profile" ]
+curl -sSf $HOST/_config/profiling | grep -q "\"id\": \"$profile\","
+curl -sSf $HOST/_config/profiling/$profile | grep -q 'function calls'
+curl -sSf "$HOST/_config/profiling/$profile?format=collapsed" \
+  | grep -q '^error_middleware (server.py:[0-9]*);auth_middleware'
+curl -sSf "$HOST/_config/profiling/$profile?format=pstats" -o /tmp/localstripe.pstats
+python -c 'import pstats; pstats.Stats("/tmp/localstripe.pstats")'
+curl -sSf $HOST/_config/profiling -d enabled=true -d sample_rate=1 \
+  | grep -q '"enabled": true,'
+code=$(curl -s -o /dev/null -w "%{http_code}" $HOST/_config/profiling \
+            -d sample_rate=2)
+[ "$code" = 400 ]
+curl -sSf -X DELETE $HOST/_config/profiling
+curl -sSf $HOST/_config/profiling | grep -q '"profiles": \[\],'
+
+# memory used by stored objects, and allocations between two calls
+res=$(curl -sSf "$HOST/_config/stats/memory?limit=3")
+grep -q '"pickle_bytes": [1-9]' <<<"$res"
+tr -d ' \n' <<<"$res" | grep -q '"customer":{"bytes":[1-9][0-9]*,"count":[1-9]'
+python -c 'import json, sys; assert len(json.load(sys.stdin)["largest"]) == 3' \
+  <<<"$res"
+curl -sSf -u $SK: $HOST/v1/balance >/dev/null
+curl -sSf "$HOST/_config/stats/memory?limit=100000" \
+  | grep -q '"id": "balance",'
+curl -sSf "$HOST/_config/stats/memory?tracemalloc=true" \
+  | grep -q '"tracemalloc": \[\]'
+curl -sSf -u $SK: $HOST/v1/customers -d email=traced@example.com
+curl -sSf "$HOST/_config/stats/memory?tracemalloc=true" \
+  | grep -q '"size_diff": '
+[ "$(curl -sSf "$HOST/_config/stats/memory?tracemalloc=false" \
+     | grep -c '"tracemalloc"')" = 0 ]
+code=$(curl -s -o /dev/null -w "%{http_code}" \
+            "$HOST/_config/stats/memory?limit=0")
+[ "$code" = 400 ]
+
+# request IDs, and time spent in phases of traced requests
+curl -sSf -u $SK: -D - -o /dev/null $HOST/v1/customers \
+  | grep -q '^Request-Id: req_'
+[ "$(curl -sSf -u $SK: -D - -o /dev/null $HOST/v1/customers \
+     | grep -c '^Server-Timing:')" = 0 ]
+timing=$(curl -sSf -u $SK: -H 'Localstripe-Trace: true' -D - -o /dev/null \
+              $HOST/v1/customers -d email=traced@example.com \
+           | grep '^Server-Timing:')
+for phase in parse auth logic export json dump webhooks total; do
+  grep -q "\b$phase;dur=[0-9.]*\b" <<<"$timing"
+done
+
+# event loop lag is measured continuously
+curl -sSf $HOST/_config/metrics \
+  | grep -q '^localstripe_event_loop_lag_seconds_count [1-9]'
+
+# the load benchmark runs its flows without errors
+res=$(python -m benchmarks.load --iterations 2 --concurrency 2 --no-webhooks)
+grep -q '^[0-9]* flows (.*), 0 failed,' <<<"$res"
+
+# micro-benchmarks run on in-process data
+res=$(python -m benchmarks.micro --sizes 10 100 --repeat 1 --min-time 0.01)
+grep -q '^list_all\[100\] .* per call' <<<"$res"
+grep -q '^webhook\.sign .* per call' <<<"$res"
+
+# synthetic datasets are generated the same way whatever the parallelism
+res=$(python -m localstripe generate --customers 30 --seed test --jobs 2 \
+                                     --output /tmp/localstripe-test-1.pickle)
+grep -q '^  customer: 30$' <<<"$res"
+grep -q '^  subscription: [1-9]' <<<"$res"
+python -m localstripe generate --customers 30 --seed test --jobs 1 \
+                               --output /tmp/localstripe-test-2.pickle
+python -c '
+import pickle, sys
+a, b = (pickle.load(open(f, "rb")) for f in sys.argv[1:])
+assert list(a) == list(b)
+totals = a["balance"]._totals
+assert sum(sum(source_types.values()) for status in totals.values()
+           for source_types in status.values()) == \
+    sum(obj.net for key, obj in a.items()
+        if key.startswith("balance_transaction:"))
+' /tmp/localstripe-test-{1,2}.pickle
+rm /tmp/localstripe-test-{1,2}.pickle
+
+# requests can be recorded, then replayed against a fresh instance, where
+# objects get other IDs
+rm -f /tmp/localstripe-test.ndjson
+python -m localstripe --port 8421 --from-scratch \
+                      --record /tmp/localstripe-test.ndjson &
+pid=$!
+for i in $(seq 50); do
+  curl -sSf -u $SK: localhost:8421/v1/balance >/dev/null && break; sleep 0.2
+done
+cus=$(curl -sSfg -u $SK: -H 'Stripe-Account: acct_record' \
+           localhost:8421/v1/customers -d email=recorded@example.com \
+      | grep -oE 'cus_\w+' | head -n 1)
+curl -sSfg -u $SK: -H 'Stripe-Account: acct_record' \
+     localhost:8421/v1/customers/$cus -d metadata[foo]=bar
+curl -sSfg -u $SK: -H 'Stripe-Account: acct_record' \
+     localhost:8421/v1/customers/$cus?expand[]=sources
+kill $pid
+[ "$(grep -c "\"path\":\"/v1/customers/$cus\"" /tmp/localstripe-test.ndjson)" \
+  = 2 ]
+python -m localstripe --port 8422 --from-scratch &
+pid=$!
+for i in $(seq 50); do
+  curl -sSf -u $SK: localhost:8422/v1/balance >/dev/null && break; sleep 0.2
+done
+res=$(python -m localstripe replay /tmp/localstripe-test.ndjson \
+                                   --url http://localhost:8422 --fast)
+grep -q '^4 requests replayed in .*, 0 with a different status' <<<"$res"
+res=$(curl -sSfg -u $SK: -H 'Stripe-Account: acct_record' \
+           localhost:8422/v1/customers)
+grep -q '"foo": "bar"' <<<"$res"
+[ "$(grep -c "$cus" <<<"$res")" = 0 ]
+kill $pid
+rm /tmp/localstripe-test.ndjson
+
+# retried requests with the same Idempotency-Key get the same response,
+# without creating objects again
+key=idempotency-$RANDOM$RANDOM
+cus=$(curl -sSfg -u $SK: -H "Idempotency-Key: $key" $HOST/v1/customers \
+           -d email=idempotent@example.com \
+      | grep -oE 'cus_\w+' | head -n 1)
+res=$(curl -sSfg -i -u $SK: -H "Idempotency-Key: $key" $HOST/v1/customers \
+           -d email=idempotent@example.com)
+grep -qi '^Idempotent-Replayed: true' <<<"$res"
+grep -q "\"id\": \"$cus\"" <<<"$res"
+[ "$(curl -sSfg -u $SK: $HOST/v1/customers?email=idempotent@example.com \
+     | grep -c '"id": "cus_')" = 1 ]
+
+# ... but not with other parameters
+code=$(curl -sg -o /dev/null -w "%{http_code}" -u $SK: \
+            -H "Idempotency-Key: $key" $HOST/v1/customers \
+            -d email=other@example.com)
+[ "$code" = 400 ]
+curl -sg -u $SK: -H "Idempotency-Key: $key" $HOST/v1/customers \
+     -d email=other@example.com | grep -q '"type": "idempotency_error"'
+
+# keys are scoped by API key, and errors are replayed too
+res=$(curl -sSfg -u sk_test_other: -H "Idempotency-Key: $key" \
+           $HOST/v1/customers -d email=idempotent@example.com)
+[ "$(grep -c "$cus" <<<"$res")" = 0 ]
+code=$(curl -sg -o /dev/null -w "%{http_code}" -u $SK: \
+            -H "Idempotency-Key: $key-bad" $HOST/v1/charges -d amount=-1)
+[ "$code" = 400 ]
+res=$(curl -sg -i -u $SK: -H "Idempotency-Key: $key-bad" $HOST/v1/charges \
+           -d amount=-1)
+grep -qi '^Idempotent-Replayed: true' <<<"$res"
+
+curl -sSf $HOST/_config/metrics \
+  | grep -q '^localstripe_idempotent_requests_total{result="replayed"} [1-9]'
+
+# with --workers, worker processes handle requests in front of the process
+# that owns the data
+python -m localstripe --port 8423 --from-scratch --workers 2 &
+pid=$!
+for i in $(seq 50); do
+  curl -sSf -u $SK: localhost:8423/v1/balance >/dev/null && break; sleep 0.2
+done
+cus=$(curl -sSfg -u $SK: -H 'Stripe-Account: acct_workers' \
+           -H 'Idempotency-Key: workers-test' \
+           localhost:8423/v1/customers -d email=workers@example.com \
+      | grep -oE 'cus_\w+' | head -n 1)
+curl -sSfg -u $SK: -H 'Stripe-Account: acct_workers' \
+     localhost:8423/v1/customers/$cus \
+  | grep -q '"email": "workers@example.com"'
+res=$(curl -sSfg -i -u $SK: -H 'Stripe-Account: acct_workers' \
+           -H 'Idempotency-Key: workers-test' \
+           localhost:8423/v1/customers -d email=workers@example.com)
+grep -qi '^Idempotent-Replayed: true' <<<"$res"
+grep -q "\"id\": \"$cus\"" <<<"$res"
+res=$(curl -sSfg -H 'Stripe-Account: acct_workers' \
+           "localhost:8423/_config/export?type=customer")
+[ "$(wc -l <<<"$res")" = 1 ]
+grep -q "$cus" <<<"$res"
+# routes of the owner process are not reachable from outside
+code=$(curl -s -o /dev/null -w '%{http_code}' \
+            localhost:8423/_config/workers/api_call \
+            -d '{"method": "GET", "path": "/v1/customers", "data": {}}')
+[ "$code" = 404 ]
+kill $pid
+
+# listen on a unix socket, and send webhooks to a receiver listening on
+# another one
+rm -f /tmp/localstripe-test.sock /tmp/localstripe-test-receiver.sock \
+      /tmp/localstripe-test-webhooks
+python - <<'PYTHON' &
+from aiohttp import web
+
+async def receive(request):
+    event = await request.json()
+    with open('/tmp/localstripe-test-webhooks', 'a') as f:
+        f.write(request.path + ' ' + event['type'] + '\n')
+    return web.Response()
+
+app = web.Application()
+app.router.add_post('/hooks', receive)
+web.run_app(app, path='/tmp/localstripe-test-receiver.sock', print=None)
+PYTHON
+receiver=$!
+python -m localstripe --unix-socket /tmp/localstripe-test.sock \
+                      --from-scratch &
+pid=$!
+for i in $(seq 50); do
+  [ -S /tmp/localstripe-test-receiver.sock ] &&
+    curl -sSf --unix-socket /tmp/localstripe-test.sock -u $SK: \
+         http://localhost/v1/balance >/dev/null && break
+  sleep 0.2
+done
+curl -sSf --unix-socket /tmp/localstripe-test.sock \
+     -H 'Stripe-Account: acct_unix' http://localhost/_config/webhooks/unix \
+     -d secret=whsec_unix -d events[]=customer.created \
+     --data-urlencode \
+     url=http+unix://%2Ftmp%2Flocalstripe-test-receiver.sock/hooks
+curl -sSfg --unix-socket /tmp/localstripe-test.sock -u $SK: \
+     -H 'Stripe-Account: acct_unix' http://localhost/v1/customers \
+     -d email=unix@example.com | grep -q '"email": "unix@example.com"'
+for i in $(seq 50); do
+  grep -q '^/hooks customer.created$' /tmp/localstripe-test-webhooks \
+    2>/dev/null && break
+  sleep 0.2
+done
+grep -q '^/hooks customer.created$' /tmp/localstripe-test-webhooks
+kill $pid $receiver
+rm /tmp/localstripe-test-webhooks